@@ -1,43 +1,189 @@
-from flask import Flask, render_template, request, redirect, session, flash, url_for, g, abort
+from flask import Flask, render_template, request, redirect, session, flash, url_for, g, abort, send_file, make_response
+from flask import has_request_context, before_render_template, template_rendered
 import requests
+import click
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import sys
+import re
+import io
+import csv
+import json
+import queue
+import uuid
+import secrets
+import tempfile
+import gzip
+import hashlib
+import hmac
+import fcntl
 import smtplib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from itertools import zip_longest
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturoTimeout
+import multiprocessing
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from datetime import datetime, timedelta
+from datetime import datetime, date
 from dotenv import load_dotenv
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 from werkzeug.utils import secure_filename
 from itsdangerous import URLSafeTimedSerializer
+from markupsafe import Markup
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "chave_secreta_sos_motoboy")
+# Limite do corpo do request: uploads maiores são recusados (413) antes de serem lidos
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", 10)) * 1024 * 1024
+
+# --- CLASSES DE ROTA ---
+# Cada rota declara sua classe (public, auth, dashboard, static, api) e o
+# before_request roda só os middlewares dessa classe (MIDDLEWARES_POR_CLASSE)
+CLASSE_POR_ENDPOINT = {'static': 'static'}
+ENDPOINTS_COM_DOMINIO = set()
+
+def classe_rota(classe, dominio=False):
+    # Vai abaixo do @app.route; o endpoint é o nome da função
+    def registrar(view):
+        CLASSE_POR_ENDPOINT[view.__name__] = classe
+        if dominio:
+            ENDPOINTS_COM_DOMINIO.add(view.__name__)
+        return view
+    return registrar
 
 # --- SEGURANÇA NATIVA (SEM BIBLIOTECA EXTERNA) ---
-# Dicionário simples na memória para limitar requisições (Rate Limit Artesanal)
-request_log = {}
+# Rate limit por janela deslizante aproximada (contador da janela atual + anterior):
+# O(1) por checagem e memória constante por chave
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory | sqlite
+RATE_LIMIT_SQLITE_PATH = os.getenv("RATE_LIMIT_SQLITE_PATH", "/tmp/motoboys_ratelimit.db")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+
+def estimar_janela(inicio, atual, anterior, agora, periodo):
+    # Avança a janela se necessário e devolve (inicio, atual, anterior, estimativa)
+    janela = agora - (agora % periodo)
+    if janela != inicio:
+        anterior = atual if janela - inicio == periodo else 0
+        atual = 0
+        inicio = janela
+    peso = 1 - (agora - inicio) / periodo
+    return inicio, atual, anterior, anterior * peso + atual
+
+class RateLimiterMemoria:
+    def __init__(self, max_chaves):
+        self.max_chaves = max_chaves
+        self._chaves = OrderedDict()  # ordem = último acesso (mais antigo primeiro)
+        self._lock = threading.Lock()
+
+    def _despejar(self, agora):
+        # Remove chaves ociosas (sem acesso há mais de duas janelas)
+        while self._chaves:
+            chave, item = next(iter(self._chaves.items()))
+            if len(self._chaves) <= self.max_chaves and item[4] > agora - 2 * item[3]:
+                break
+            self._chaves.popitem(last=False)
+
+    def permitir(self, chave, limite, periodo):
+        agora = time.time()
+        with self._lock:
+            inicio, atual, anterior = self._chaves.get(chave, (0, 0, 0))[:3]
+            inicio, atual, anterior, estimativa = estimar_janela(inicio, atual, anterior, agora, periodo)
+            permitido = estimativa < limite
+            if permitido:
+                atual += 1
+            self._chaves[chave] = (inicio, atual, anterior, periodo, agora)
+            self._chaves.move_to_end(chave)
+            self._despejar(agora)
+            return permitido
+
+class RateLimiterSQLite:
+    # Compartilhado entre os workers do gunicorn via arquivo SQLite local
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._local = threading.local()
+        self._ultima_limpeza = 0
+
+    def _conexao(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.caminho, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit ("
+                "chave TEXT PRIMARY KEY, inicio REAL, atual INTEGER, anterior INTEGER, periodo REAL, visto REAL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def permitir(self, chave, limite, periodo):
+        agora = time.time()
+        conn = self._conexao()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT inicio, atual, anterior FROM rate_limit WHERE chave = ?", (chave,)).fetchone()
+            inicio, atual, anterior = row if row else (0, 0, 0)
+            inicio, atual, anterior, estimativa = estimar_janela(inicio, atual, anterior, agora, periodo)
+            permitido = estimativa < limite
+            if permitido:
+                atual += 1
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit VALUES (?, ?, ?, ?, ?, ?)",
+                (chave, inicio, atual, anterior, periodo, agora),
+            )
+            if agora - self._ultima_limpeza > 60:
+                conn.execute("DELETE FROM rate_limit WHERE visto < ? - 2 * periodo", (agora,))
+                self._ultima_limpeza = agora
+            conn.execute("COMMIT")
+            return permitido
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+def criar_rate_limiter():
+    if RATE_LIMIT_BACKEND == "sqlite":
+        return RateLimiterSQLite(RATE_LIMIT_SQLITE_PATH)
+    return RateLimiterMemoria(RATE_LIMIT_MAX_KEYS)
+
+rate_limiter = criar_rate_limiter()
 
 def check_limit(key, limit, period_seconds):
-    now = datetime.now()
-    if key not in request_log:
-        request_log[key] = []
-    
-    # Limpa logs antigos
-    request_log[key] = [t for t in request_log[key] if t > now - timedelta(seconds=period_seconds)]
-    
-    if len(request_log[key]) >= limit:
-        return False
-        
-    request_log[key].append(now)
-    return True
+    try:
+        permitido = rate_limiter.permitir(key, limit, period_seconds)
+        if not permitido:
+            metricas.inc("rate_limit_rejections_total", limiter=key.split('_', 1)[0])
+        return permitido
+    except Exception as e:
+        # Falha no backend não pode derrubar login/cadastro
+        print(f"Erro no rate limit: {e}")
+        return True
 
 def get_ip():
     if request.headers.getlist("X-Forwarded-For"):
         return request.headers.getlist("X-Forwarded-For")[0]
     return request.remote_addr
 
+def segredo_confere(recebido, esperado):
+    # Tempo constante (não vaza o prefixo certo); bytes aceitam header fora do ASCII
+    return hmac.compare_digest((recebido or '').encode('utf-8'), esperado.encode('utf-8'))
+
 # --- CONFIGURAÇÕES ---
 DIRECTUS_URL = os.getenv("DIRECTUS_URL", "https://api2.leanttro.com").rstrip('/')
 DIRECTUS_TOKEN = os.getenv("DIRECTUS_TOKEN", "") 
@@ -59,29 +205,1381 @@ SYSTEM_DOMAINS = [
     'localhost',
     '127.0.0.1'
 ]
+# Conjuntos para comparação exata e por sufixo (subdomínios dos domínios do sistema)
+SYSTEM_DOMAINS_SET = frozenset(SYSTEM_DOMAINS)
+SYSTEM_DOMAINS_SUFFIXES = tuple('.' + d for d in SYSTEM_DOMAINS)
+
+def e_dominio_sistema(host):
+    return host in SYSTEM_DOMAINS_SET or host.endswith(SYSTEM_DOMAINS_SUFFIXES)
+
+# --- MÉTRICAS ---
+# Contadores e histogramas em memória, expostos em /metrics no formato Prometheus.
+# Com METRICS_DIR, cada worker grava um snapshot periódico e /metrics soma todos
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True") == "True"
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+SERVER_TIMING = os.getenv("SERVER_TIMING", "False") == "True"
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metricas:
+    def __init__(self):
+        self._contadores = {}   # (nome, labels) -> valor
+        self._histogramas = {}  # (nome, labels) -> [contagens por bucket..., soma, total]
+        self._lock = threading.Lock()
+        self._pid_flush = None
+        self._pid = os.getpid()
+
+    def inc(self, nome, valor=1, **labels):
+        if not METRICS_ENABLED: return
+        chave = (nome, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **labels):
+        if not METRICS_ENABLED: return
+        chave = (nome, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            h = self._histogramas.get(chave)
+            if h is None:
+                h = self._histogramas[chave] = [0] * (len(BUCKETS_LATENCIA) + 2)
+            for i, limite in enumerate(BUCKETS_LATENCIA):
+                if valor <= limite:
+                    h[i] += 1
+                    break
+            h[-2] += valor
+            h[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "contadores": [[n, list(l), v] for (n, l), v in self._contadores.items()],
+                "histogramas": [[n, list(l), list(h)] for (n, l), h in self._histogramas.items()],
+            }
+
+    def _loop_flush(self):
+        caminho = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                _escrever_atomico(caminho, json.dumps(self.snapshot()).encode('utf-8'))
+            except Exception as e:
+                print(f"Erro gravando métricas: {e}")
+
+    def iniciar(self):
+        if self._pid != os.getpid():
+            # Worker criado por fork do master (preload_app): zera o que veio do master
+            with self._lock:
+                self._contadores, self._histogramas = {}, {}
+                self._pid = os.getpid()
+        if not METRICS_DIR or self._pid_flush == os.getpid():
+            return
+        self._pid_flush = os.getpid()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        threading.Thread(target=self._loop_flush, daemon=True).start()
+
+    def _snapshots(self):
+        if not METRICS_DIR:
+            return [self.snapshot()]
+        # Snapshot atual deste worker + o último gravado pelos demais
+        snaps = [self.snapshot()]
+        for nome in os.listdir(METRICS_DIR):
+            if not nome.endswith('.json') or nome == f"{os.getpid()}.json":
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, nome)) as f:
+                    snaps.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snaps
+
+    def exportar(self):
+        contadores, histogramas = {}, {}
+        for snap in self._snapshots():
+            for nome, labels, valor in snap["contadores"]:
+                chave = (nome, tuple(tuple(x) for x in labels))
+                contadores[chave] = contadores.get(chave, 0) + valor
+            for nome, labels, h in snap["histogramas"]:
+                chave = (nome, tuple(tuple(x) for x in labels))
+                atual = histogramas.setdefault(chave, [0] * len(h))
+                for i, v in enumerate(h):
+                    atual[i] += v
+
+        def fmt(labels, extra=()):
+            pares = list(labels) + list(extra)
+            if not pares: return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pares) + '}'
+
+        linhas, tipos = [], set()
+        for (nome, labels), valor in sorted(contadores.items()):
+            if nome not in tipos:
+                linhas.append(f"# TYPE {nome} counter")
+                tipos.add(nome)
+            linhas.append(f"{nome}{fmt(labels)} {valor}")
+        for (nome, labels), h in sorted(histogramas.items()):
+            if nome not in tipos:
+                linhas.append(f"# TYPE {nome} histogram")
+                tipos.add(nome)
+            acumulado = 0
+            for i, limite in enumerate(BUCKETS_LATENCIA):
+                acumulado += h[i]
+                linhas.append(f"{nome}_bucket{fmt(labels, [('le', limite)])} {acumulado}")
+            linhas.append(f"{nome}_bucket{fmt(labels, [('le', '+Inf')])} {h[-1]}")
+            linhas.append(f"{nome}_sum{fmt(labels)} {round(h[-2], 6)}")
+            linhas.append(f"{nome}_count{fmt(labels)} {h[-1]}")
+        return '\n'.join(linhas) + '\n'
+
+metricas = Metricas()
+
+def registrar_tempo(etapa, duracao):
+    # Acumula por request para o header Server-Timing
+    if has_request_context():
+        tempos = g.setdefault('tempos', {})
+        total, n = tempos.get(etapa, (0.0, 0))
+        tempos[etapa] = (total + duracao, n + 1)
+
+RE_ID_CAMINHO = re.compile(r'/(\d+|[0-9a-fA-F-]{36})(?=/|$)')
+
+# --- CLIENTE DIRECTUS ---
+# Sessão HTTP compartilhada (keep-alive + pool de conexões), uma por processo
+DIRECTUS_CONNECT_TIMEOUT = float(os.getenv("DIRECTUS_CONNECT_TIMEOUT", 3))
+DIRECTUS_READ_TIMEOUT = float(os.getenv("DIRECTUS_READ_TIMEOUT", 10))
+DIRECTUS_RETRIES = int(os.getenv("DIRECTUS_RETRIES", 2))
+DIRECTUS_RETRY_BACKOFF = float(os.getenv("DIRECTUS_RETRY_BACKOFF", 0.3))
+DIRECTUS_POOL_CONNECTIONS = int(os.getenv("DIRECTUS_POOL_CONNECTIONS", 4))
+DIRECTUS_POOL_MAXSIZE = int(os.getenv("DIRECTUS_POOL_MAXSIZE", 16))
+DIRECTUS_BREAKER_FAILURES = int(os.getenv("DIRECTUS_BREAKER_FAILURES", 5))
+DIRECTUS_BREAKER_RESET = float(os.getenv("DIRECTUS_BREAKER_RESET", 15))
+
+class DirectusIndisponivel(requests.ConnectionError):
+    pass
+
+class CircuitBreaker:
+    # fechado -> (N falhas seguidas) -> aberto -> (após reset) -> meio-aberto: uma sonda
+    def __init__(self, max_falhas, tempo_reset):
+        self.max_falhas = max_falhas
+        self.tempo_reset = tempo_reset
+        self.estado = 'fechado'
+        self._falhas = 0
+        self._aberto_ate = 0
+        self._sondando = False
+        self._lock = threading.Lock()
+
+    def permitir(self):
+        with self._lock:
+            if self.estado == 'fechado':
+                return True
+            if self.estado == 'aberto' and time.monotonic() >= self._aberto_ate:
+                self.estado = 'meio-aberto'
+                self._sondando = False
+            if self.estado == 'meio-aberto' and not self._sondando:
+                self._sondando = True
+                return True
+            return False
+
+    def sucesso(self):
+        with self._lock:
+            self.estado = 'fechado'
+            self._falhas = 0
+            self._sondando = False
+
+    def falha(self):
+        with self._lock:
+            self._falhas += 1
+            if self.estado == 'meio-aberto' or self._falhas >= self.max_falhas:
+                if self.estado != 'aberto':
+                    metricas.inc("directus_breaker_open_total")
+                    print("Circuit breaker do Directus aberto.")
+                self.estado = 'aberto'
+                self._aberto_ate = time.monotonic() + self.tempo_reset
+                self._sondando = False
+
+class DirectusClient:
+    def __init__(self, base_url, token):
+        self.base_url = base_url
+        self.token = token
+        self.timeout = (DIRECTUS_CONNECT_TIMEOUT, DIRECTUS_READ_TIMEOUT)
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.breaker = CircuitBreaker(DIRECTUS_BREAKER_FAILURES, DIRECTUS_BREAKER_RESET)
+
+    def _criar_sessao(self):
+        # Retry com backoff apenas em leituras (idempotentes)
+        retry = Retry(
+            total=DIRECTUS_RETRIES,
+            backoff_factor=DIRECTUS_RETRY_BACKOFF,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=DIRECTUS_POOL_CONNECTIONS,
+            pool_maxsize=DIRECTUS_POOL_MAXSIZE,
+            max_retries=retry,
+        )
+        s = requests.Session()
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        s.headers.update({"Authorization": f"Bearer {self.token}"})
+        return s
+
+    @property
+    def session(self):
+        # Sessões não sobrevivem ao fork: cada worker cria a sua
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._criar_sessao()
+                    self._pid = os.getpid()
+        return self._session
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        rota = RE_ID_CAMINHO.sub('/:id', '/' + path.lstrip('/'))
+        if not self.breaker.permitir():
+            metricas.inc("directus_requests_total", method=method, path=rota, status="breaker_aberto")
+            raise DirectusIndisponivel("Circuit breaker aberto")
+        inicio = time.perf_counter()
+        try:
+            resp = self.session.request(method, f"{self.base_url}/{path.lstrip('/')}", **kwargs)
+        except requests.RequestException as e:
+            self.breaker.falha()
+            metricas.inc("directus_requests_total", method=method, path=rota, status=type(e).__name__)
+            raise
+        finally:
+            duracao = time.perf_counter() - inicio
+            metricas.observar("directus_request_duration_seconds", duracao, method=method, path=rota)
+            registrar_tempo('directus', duracao)
+        if resp.status_code >= 500:
+            self.breaker.falha()
+        else:
+            self.breaker.sucesso()
+        metricas.inc("directus_requests_total", method=method, path=rota, status=resp.status_code)
+        metricas.inc("directus_response_bytes_total", len(resp.content), method=method, path=rota)
+        return resp
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('PATCH', path, **kwargs)
 
-def get_headers():
-    return {"Authorization": f"Bearer {DIRECTUS_TOKEN}", "Content-Type": "application/json"}
+directus = DirectusClient(DIRECTUS_URL, DIRECTUS_TOKEN)
 
-def get_upload_headers():
-    return {"Authorization": f"Bearer {DIRECTUS_TOKEN}"}
+# --- CAMPOS POR CASO DE USO ---
+# Cada leitura pede ao Directus só as colunas que usa (fields=); o hash da senha
+# só aparece nas leituras de autenticação
+CAMPOS_SOS = (
+    'id', 'slug', 'nome_completo', 'data_nascimento', 'tipo_sanguineo', 'alergias_condicoes',
+    'contato_nome', 'contato_telefone', 'contato_nome2', 'contato_telefone2', 'plano_saude',
+    'foto', 'date_created', 'date_updated',
+)
+CAMPOS_DOMINIO = CAMPOS_SOS + ('dominio_proprio',)
+CAMPOS_PAINEL = CAMPOS_SOS + ('email', 'dominio_proprio')
+CAMPOS_AUTH = ('id', 'email', 'senha', 'nome_completo')
 
-def get_img_url(image_id):
-    if not image_id: return "https://placehold.co/400x400?text=Sem+Foto"
-    return f"{DIRECTUS_URL}/assets/{image_id}"
+def campos(lista):
+    return ','.join(lista)
 
-def upload_file(file_storage):
+class Motoboy:
+    # Registro compacto (sem __dict__) para perfis em cache e templates
+    __slots__ = tuple(sorted(set(CAMPOS_PAINEL + CAMPOS_AUTH))) + ('foto_url',)
+
+    def __init__(self, **dados):
+        for campo in self.__slots__:
+            setattr(self, campo, dados.get(campo))
+
+    @classmethod
+    def from_directus(cls, dados, tamanho_foto=256):
+        m = cls(**dados)
+        m.foto_url = get_img_url(m.foto, tamanho_foto)
+        return m
+
+    def as_dict(self):
+        return {campo: getattr(self, campo) for campo in self.__slots__ if getattr(self, campo) is not None}
+
+# --- CACHE DE PERFIS PÚBLICOS ---
+# Cache LRU em memória por slug, com TTL e cache negativo para slugs inexistentes.
+# Cada worker tem o seu: um acerto só vale se nenhuma invalidação foi marcada na
+# réplica compartilhada depois que a entrada foi guardada (ver invalidar_perfil)
+PROFILE_CACHE_BACKEND = os.getenv("PROFILE_CACHE_BACKEND", "memory")
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 2048))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 300))
+PROFILE_CACHE_NEGATIVE_TTL = int(os.getenv("PROFILE_CACHE_NEGATIVE_TTL", 60))
+PROFILE_STORE_PATH = os.getenv("PROFILE_STORE_PATH", "/tmp/motoboys_perfis.db")
+INVALIDATION_RETENTION = 86400  # maior que qualquer TTL das caches em memória
+
+class Invalidacoes:
+    # Marcas "chave -> quando foi invalidada" no SQLite da réplica, visíveis a todos os workers
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._local = threading.local()
+        self._marcacoes = 0
+
+    def _conexao(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.caminho, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS invalidacoes (chave TEXT PRIMARY KEY, em REAL NOT NULL)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def marcar(self, chaves):
+        agora = time.time()
+        conn = self._conexao()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO invalidacoes (chave, em) VALUES (?, ?)", [(c, agora) for c in chaves])
+            self._marcacoes += 1
+            if self._marcacoes % 500 == 0:
+                conn.execute("DELETE FROM invalidacoes WHERE em < ?", (agora - INVALIDATION_RETENTION,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def ultima(self, chaves):
+        row = self._conexao().execute(
+            f"SELECT MAX(em) FROM invalidacoes WHERE chave IN ({','.join('?' * len(chaves))})", chaves
+        ).fetchone()
+        return row[0] or 0
+
+invalidacoes = Invalidacoes(PROFILE_STORE_PATH)
+
+def chaves_invalidacao(prefixo, chave, perfil):
+    # Entrada negativa só depende da própria chave; a positiva, também do id do motoboy
+    chaves = [f"{prefixo}:{chave}"]
+    if perfil is not None:
+        chaves.append(f"id:{perfil.id}")
+    return chaves
+
+def perfil_em_dia(chave, perfil, guardado_em):
     try:
-        url = f"{DIRECTUS_URL}/files"
-        filename = secure_filename(file_storage.filename)
-        files = {'file': (filename, file_storage.read(), file_storage.mimetype)}
-        response = requests.post(url, headers=get_upload_headers(), files=files)
+        return invalidacoes.ultima(chaves_invalidacao("slug", chave, perfil)) < guardado_em
+    except Exception as e:
+        print(f"Erro consultando invalidações: {e}")
+        return True
+
+def dominio_em_dia(host, perfil, guardado_em):
+    try:
+        return invalidacoes.ultima(chaves_invalidacao("host", host, perfil)) < guardado_em
+    except Exception as e:
+        print(f"Erro consultando invalidações: {e}")
+        return True
+
+class CacheMemoria:
+    def __init__(self, maxsize, ttl, ttl_negativo, nome="perfis", validar=None):
+        # validar(chave, valor, guardado_em) -> False descarta a entrada
+        self.nome = nome
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self.validar = validar
+        self._dados = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        # Retorna (achou, valor). valor None = cache negativo (slug não existe)
+        with self._lock:
+            item = self._dados.get(chave)
+            if item is not None and item[0] < time.monotonic():
+                del self._dados[chave]
+                item = None
+            if item is not None:
+                self._dados.move_to_end(chave)
+        if item is not None and self.validar and not self.validar(chave, item[1], item[2]):
+            with self._lock:
+                if self._dados.get(chave) is item:
+                    del self._dados[chave]
+            metricas.inc("cache_invalidated_total", cache=self.nome)
+            item = None
+        if item is None:
+            metricas.inc("cache_requests_total", cache=self.nome, result="miss")
+            return False, None
+        metricas.inc("cache_requests_total", cache=self.nome, result="hit")
+        return True, item[1]
+
+    def set(self, chave, valor):
+        ttl = self.ttl if valor is not None else self.ttl_negativo
+        with self._lock:
+            self._dados[chave] = (time.monotonic() + ttl, valor, time.time())
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.maxsize:
+                self._dados.popitem(last=False)
+
+    def invalidar(self, chave):
+        with self._lock:
+            self._dados.pop(chave, None)
+
+    def itens(self):
+        # Entradas positivas ainda válidas, da mais recente para a mais antiga
+        agora = time.monotonic()
+        with self._lock:
+            return [(chave, valor) for chave, (expira, valor, _) in reversed(self._dados.items())
+                    if valor is not None and expira >= agora]
+
+    def invalidar_id(self, motoboy_id):
+        # Usado pelo painel, que só conhece o id do motoboy
+        with self._lock:
+            for chave, (_, valor, _) in list(self._dados.items()):
+                if valor is not None and str(valor.id) == str(motoboy_id):
+                    del self._dados[chave]
+
+class CacheNulo:
+    def get(self, chave):
+        return False, None
+
+    def set(self, chave, valor):
+        pass
+
+    def invalidar(self, chave):
+        pass
+
+    def invalidar_id(self, motoboy_id):
+        pass
+
+    def itens(self):
+        return []
+
+def criar_cache_perfis():
+    if PROFILE_CACHE_BACKEND == "none":
+        return CacheNulo()
+    return CacheMemoria(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, PROFILE_CACHE_NEGATIVE_TTL, validar=perfil_em_dia)
+
+profile_cache = criar_cache_perfis()
+
+# Índice local de slugs/e-mails já em uso: o cadastro recusa sem consultar o Directus.
+# Só guarda positivos (ausência aqui não garante que esteja livre) e expira,
+# porque o e-mail pode mudar no painel
+TAKEN_INDEX_SIZE = int(os.getenv("TAKEN_INDEX_SIZE", 50000))
+TAKEN_INDEX_TTL = int(os.getenv("TAKEN_INDEX_TTL", 3600))
+indice_em_uso = CacheMemoria(TAKEN_INDEX_SIZE, TAKEN_INDEX_TTL, TAKEN_INDEX_TTL, nome="em_uso")
+
+# Registro completo do painel por motoboy logado, só para exibir. A sessão guarda
+# a versão (date_updated) da última leitura/gravação; cópia de outra versão ou com
+# invalidação marcada depois (webhook, sincronização, outro worker) é descartada.
+# Edição feita direto no Directus sem webhook nem réplica só aparece após o TTL
+PAINEL_CACHE_SIZE = int(os.getenv("PAINEL_CACHE_SIZE", 5000))
+PAINEL_CACHE_TTL = int(os.getenv("PAINEL_CACHE_TTL", 120))
+
+def painel_em_dia(mid, user, guardado_em):
+    try:
+        return invalidacoes.ultima([f"id:{mid}"]) < guardado_em
+    except Exception as e:
+        print(f"Erro consultando invalidações: {e}")
+        return True
+
+painel_cache = CacheMemoria(PAINEL_CACHE_SIZE, PAINEL_CACHE_TTL, 0, nome="painel", validar=painel_em_dia)
+
+def versao_registro(motoboy):
+    return str(motoboy.date_updated or motoboy.date_created or '')
+
+def marcar_em_uso(motoboy):
+    if motoboy.slug:
+        indice_em_uso.set(f"slug:{motoboy.slug.lower()}", True)
+    if motoboy.email:
+        indice_em_uso.set(f"email:{motoboy.email}", True)
+
+def verificar_disponibilidade(slug, email):
+    # Devolve (conflito, id_reserva): conflito 'slug', 'email' ou None (livre);
+    # id_reserva é o registro draft do adesivo pré-provisionado, se houver.
+    # Uma única consulta com _or
+    if indice_em_uso.get(f"slug:{slug}")[0]: return 'slug', None
+    if indice_em_uso.get(f"email:{email}")[0]: return 'email', None
+
+    r = directus.get("/items/motoboys", params={
+        "filter[_or][0][slug][_eq]": slug,
+        "filter[_or][1][email][_eq]": email,
+        "fields": "id,slug,email,status",
+        "limit": 2,
+    })
+    r.raise_for_status()
+    encontrados = r.json().get('data') or []
+    reserva = next((d for d in encontrados if (d.get('slug') or '').lower() == slug and d.get('status') == 'draft'), None)
+    usados = [Motoboy(**d) for d in encontrados if d is not reserva]
+    for motoboy in usados:
+        marcar_em_uso(motoboy)
+    if any((m.slug or '').lower() == slug for m in usados): return 'slug', None
+    if any(m.email == email for m in usados): return 'email', None
+    return None, reserva['id'] if reserva else None
+
+# --- MAPA DE DOMÍNIOS PRÓPRIOS ---
+# host -> perfil, pré-carregado no boot e atualizado em segundo plano
+DOMAIN_CACHE_SIZE = int(os.getenv("DOMAIN_CACHE_SIZE", 10000))
+DOMAIN_CACHE_TTL = int(os.getenv("DOMAIN_CACHE_TTL", 600))
+DOMAIN_CACHE_NEGATIVE_TTL = int(os.getenv("DOMAIN_CACHE_NEGATIVE_TTL", 300))
+DOMAIN_REFRESH_INTERVAL = int(os.getenv("DOMAIN_REFRESH_INTERVAL", 300))
+DOMAIN_PRELOAD = os.getenv("DOMAIN_PRELOAD", "True") == "True"
+
+class MapaDominios:
+    # LRU limitado: hosts desconhecidos (cache negativo) não fazem o mapa crescer sem fim
+    def __init__(self, maxsize, ttl, ttl_negativo, intervalo):
+        self.intervalo = intervalo
+        self._cache = CacheMemoria(maxsize, ttl, ttl_negativo, nome="dominios", validar=dominio_em_dia)
+        self._pid_thread = None
+
+    def get(self, host):
+        return self._cache.get(host)
+
+    def set(self, host, perfil):
+        self._cache.set(host, perfil)
+
+    def invalidar(self, host):
+        self._cache.invalidar(host)
+
+    def invalidar_id(self, motoboy_id):
+        self._cache.invalidar_id(motoboy_id)
+
+    def carregar_todos(self):
+        # Carrega todos os motoboys com domínio próprio de uma vez
+        r = directus.get("/items/motoboys", params={
+            "filter[dominio_proprio][_nempty]": "true",
+            "filter[status][_eq]": "published",
+            "fields": campos(CAMPOS_DOMINIO),
+            "limit": -1,
+        })
+        r.raise_for_status()
+        novos = {}
+        for dados in r.json().get('data') or []:
+            perfil = Motoboy.from_directus(dados)
+            host = (perfil.dominio_proprio or '').strip().lower()
+            if host:
+                novos[host] = perfil
+        # Domínio que perdeu o dono sai; os negativos seguem o próprio TTL no LRU
+        for host, _ in self._cache.itens():
+            if host not in novos:
+                self._cache.invalidar(host)
+        for host, perfil in novos.items():
+            self._cache.set(host, perfil)
+
+    def _loop_atualizacao(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.carregar_todos()
+            except Exception as e:
+                print(f"Erro atualizando domínios: {e}")
+
+    def iniciar(self):
+        # Uma thread por processo (cada worker do gunicorn inicia a sua)
+        if self._pid_thread == os.getpid():
+            return
+        self._pid_thread = os.getpid()
+        threading.Thread(target=self._loop_atualizacao, daemon=True).start()
+
+domain_map = MapaDominios(DOMAIN_CACHE_SIZE, DOMAIN_CACHE_TTL, DOMAIN_CACHE_NEGATIVE_TTL, DOMAIN_REFRESH_INTERVAL)
+
+def invalidar_perfil(mid=None, slug=None, host=None):
+    # Limpa as caches deste worker e marca na réplica, para os outros workers
+    # descartarem suas cópias no próximo acerto
+    chaves = []
+    if mid:
+        profile_cache.invalidar_id(mid)
+        domain_map.invalidar_id(mid)
+        chaves.append(f"id:{mid}")
+    if slug:
+        profile_cache.invalidar(slug.strip().lower())
+        chaves.append(f"slug:{slug.strip().lower()}")
+    if host:
+        domain_map.invalidar(host.strip().lower())
+        chaves.append(f"host:{host.strip().lower()}")
+    if not chaves: return
+    try:
+        invalidacoes.marcar(chaves)
+    except Exception as e:
+        print(f"Erro marcando invalidação: {e}")
+
+def get_img_url(image_id, tamanho=256):
+    # Fotos passam pelo proxy /img (miniatura + cache); sem foto, placeholder local
+    if not image_id: return "/img/placeholder.svg"
+    return f"/img/{image_id}?s={tamanho}"
+
+# --- UPLOAD DE FOTOS ---
+# A foto é gravada em arquivo temporário e enviada ao Directus em segundo plano,
+# em streaming (multipart chunked) e, com Pillow, já reduzida e sem EXIF
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 2))
+UPLOAD_MAX_DIMENSION = int(os.getenv("UPLOAD_MAX_DIMENSION", 1024))  # 0 = não reduz
+UPLOAD_QUALITY = int(os.getenv("UPLOAD_QUALITY", 82))
+
+class ExecutorPorProcesso:
+    # ThreadPoolExecutor não sobrevive ao fork: cria um por processo, sob demanda
+    def __init__(self, workers, prefixo):
+        self.workers = workers
+        self.prefixo = prefixo
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.prefixo)
+                    self._pid = os.getpid()
+        return self._executor.submit(fn, *args, **kwargs)
+
+upload_executor = ExecutorPorProcesso(UPLOAD_WORKERS, "upload")
+
+def _multipart_stream(arquivo, filename, mimetype, boundary):
+    yield (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: {mimetype}\r\n\r\n'
+    ).encode('utf-8')
+    while True:
+        bloco = arquivo.read(UPLOAD_CHUNK_SIZE)
+        if not bloco: break
+        yield bloco
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+def upload_file(arquivo, filename, mimetype):
+    try:
+        boundary = uuid.uuid4().hex
+        response = directus.post(
+            "/files",
+            data=_multipart_stream(arquivo, secure_filename(filename) or 'foto', mimetype, boundary),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+        )
         if response.status_code in [200, 201]:
             return response.json()['data']['id']
+        print(f"Erro Upload: {response.status_code} {response.text[:200]}")
     except Exception as e:
         print(f"Erro Upload: {e}")
     return None
 
+def preprocessar_foto(caminho):
+    # Reduz e regrava sem metadados; devolve (caminho, mimetype, extensão) ou None
+    if Image is None or not UPLOAD_MAX_DIMENSION:
+        return None
+    with Image.open(caminho) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((UPLOAD_MAX_DIMENSION, UPLOAD_MAX_DIMENSION), Image.LANCZOS)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        fd, saida = tempfile.mkstemp(prefix='foto_', suffix='.jpg')
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, 'JPEG', quality=UPLOAD_QUALITY, optimize=True)
+    return saida, 'image/jpeg', '.jpg'
+
+def processar_foto(mid, caminho, filename, mimetype):
+    processado = None
+    try:
+        try:
+            processado = preprocessar_foto(caminho)
+        except Exception as e:
+            print(f"Erro processando foto (enviando original): {e}")
+        if processado:
+            envio, mimetype, ext = processado
+            filename = os.path.splitext(filename)[0] + ext
+        else:
+            envio = caminho
+
+        with open(envio, 'rb') as f:
+            fid = upload_file(f, filename, mimetype)
+        if not fid:
+            metricas.inc("upload_errors_total", etapa="envio")
+            return
+        r = directus.patch(f"/items/motoboys/{mid}", json={"foto": fid}, params={"fields": campos(CAMPOS_PAINEL)})
+        if r.status_code in [200, 201]:
+            perfil_atualizado(mid, Motoboy.from_directus(r.json()['data']))
+        else:
+            metricas.inc("upload_errors_total", etapa="registro")
+            print(f"Erro salvando foto do motoboy {mid}: {r.status_code}")
+    except Exception as e:
+        # Roda no upload_executor e ninguém lê o futuro: sem isto o erro sumiria
+        metricas.inc("upload_errors_total", etapa="excecao")
+        print(f"Erro salvando foto do motoboy {mid}: {e}")
+    finally:
+        for arquivo in (caminho, processado[0] if processado else None):
+            if arquivo:
+                try:
+                    os.remove(arquivo)
+                except FileNotFoundError:
+                    pass
+
+def agendar_foto(mid, file_storage):
+    # Copia o upload para disco (em blocos) e libera o request
+    fd, caminho = tempfile.mkstemp(prefix='upload_')
+    with os.fdopen(fd, 'wb') as f:
+        file_storage.save(f, UPLOAD_CHUNK_SIZE)
+    upload_executor.submit(processar_foto, mid, caminho, file_storage.filename, file_storage.mimetype)
+
+# --- RÉPLICA LOCAL DOS PERFIS PÚBLICOS ---
+# Cópia em SQLite (compartilhada entre workers) só com os campos públicos, indexada
+# por slug e por domínio. Um único processo (lock em arquivo) sincroniza: carga
+# completa paginada e depois deltas por date_updated; o webhook do Directus
+# adianta as mudanças. Enquanto a réplica está em dia, /<slug> e domínios próprios
+# não consultam o Directus. Fora de dia, ela serve de última cópia boa: se o
+# Directus falha ou estoura o orçamento, a página SOS sai daqui
+PROFILE_READ_BUDGET = float(os.getenv("PROFILE_READ_BUDGET", 1.5))
+PROFILE_FRESH_SECONDS = int(os.getenv("PROFILE_FRESH_SECONDS", PROFILE_CACHE_TTL))
+PROFILE_REFRESH_WORKERS = int(os.getenv("PROFILE_REFRESH_WORKERS", 4))
+REPLICA_SYNC = os.getenv("REPLICA_SYNC", "1") == "1"
+REPLICA_SYNC_INTERVAL = int(os.getenv("REPLICA_SYNC_INTERVAL", 30))
+REPLICA_FULL_INTERVAL = int(os.getenv("REPLICA_FULL_INTERVAL", 6 * 3600))  # pega exclusões sem webhook
+REPLICA_MAX_LAG = int(os.getenv("REPLICA_MAX_LAG", REPLICA_SYNC_INTERVAL * 4))
+REPLICA_PAGE_SIZE = int(os.getenv("REPLICA_PAGE_SIZE", 500))
+DIRECTUS_WEBHOOK_SECRET = os.getenv("DIRECTUS_WEBHOOK_SECRET", "")
+
+def carimbo(dados):
+    # Versão do registro para os deltas (date_updated é nulo até a 1ª edição)
+    return dados.get('date_updated') or dados.get('date_created') or ''
+
+class PerfisLocais:
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._local = threading.local()
+        self._pid_thread = None
+
+    def _conexao(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.caminho, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS perfis ("
+                "slug TEXT PRIMARY KEY, id TEXT, dados TEXT NOT NULL, salvo_em REAL NOT NULL)"
+            )
+            colunas = {c[1] for c in conn.execute("PRAGMA table_info(perfis)")}
+            if 'dominio' not in colunas:
+                conn.execute("ALTER TABLE perfis ADD COLUMN dominio TEXT")
+                conn.execute("ALTER TABLE perfis ADD COLUMN atualizado TEXT")
+            if 'foto' not in colunas:
+                conn.execute("ALTER TABLE perfis ADD COLUMN foto TEXT")
+                conn.execute("UPDATE perfis SET foto = json_extract(dados, '$.foto')")
+            conn.execute("CREATE INDEX IF NOT EXISTS perfis_dominio ON perfis (dominio) WHERE dominio IS NOT NULL")
+            conn.execute("CREATE INDEX IF NOT EXISTS perfis_foto ON perfis (foto) WHERE foto IS NOT NULL")
+            conn.execute("CREATE INDEX IF NOT EXISTS perfis_id ON perfis (id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _meta(self, chave, padrao=None):
+        row = self._conexao().execute("SELECT valor FROM meta WHERE chave = ?", (chave,)).fetchone()
+        return row[0] if row else padrao
+
+    def _set_meta(self, chave, valor, conn=None):
+        (conn or self._conexao()).execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES (?, ?)", (chave, str(valor)))
+
+    def get(self, slug):
+        # (Motoboy, salvo_em) ou None
+        row = self._conexao().execute("SELECT dados, salvo_em FROM perfis WHERE slug = ?", (slug,)).fetchone()
+        if not row:
+            return None
+        return Motoboy.from_directus(json.loads(row[0])), row[1]
+
+    def get_dominio(self, host, desde=0):
+        row = self._conexao().execute(
+            "SELECT dados FROM perfis WHERE dominio = ? AND salvo_em >= ? LIMIT 1", (host, desde)
+        ).fetchone()
+        return Motoboy.from_directus(json.loads(row[0])) if row else None
+
+    def sincronizada(self):
+        # Réplica é a fonte de leitura só com carga completa e sincronização recente
+        if not REPLICA_SYNC: return False
+        try:
+            return time.time() - float(self._meta('sincronizado_em', 0)) < REPLICA_MAX_LAG
+        except Exception as e:
+            print(f"Erro lendo estado da réplica: {e}")
+            return False
+
+    def _linhas(self, registros, agora):
+        for dados in registros:
+            slug = (dados.get('slug') or '').strip().lower()
+            if not slug: continue
+            dominio = (dados.get('dominio_proprio') or '').strip().lower() or None
+            publico = {c: dados.get(c) for c in CAMPOS_DOMINIO}
+            yield slug, str(dados.get('id')), dominio, dados.get('foto'), json.dumps(publico), carimbo(dados), agora
+
+    def salvar_lote(self, registros, agora=None):
+        # registros: dicts do Directus (ao menos CAMPOS_DOMINIO). Sem status = publicado;
+        # reservas (draft) e arquivados saem da réplica
+        publicados = [d for d in registros if d.get('status', 'published') == 'published']
+        retirados = [(str(d.get('id')),) for d in registros if d.get('status', 'published') != 'published']
+        linhas = list(self._linhas(publicados, agora or time.time()))
+        if not linhas and not retirados: return
+        conn = self._conexao()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("DELETE FROM perfis WHERE id = ?", retirados)
+            for linha in linhas:
+                # Slug trocado: a cópia antiga não pode continuar respondendo
+                conn.execute("DELETE FROM perfis WHERE id = ? AND slug != ?", (linha[1], linha[0]))
+            conn.executemany(
+                "INSERT OR REPLACE INTO perfis (slug, id, dominio, foto, dados, atualizado, salvo_em) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                linhas,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def salvar(self, motoboy):
+        self.salvar_lote([{c: getattr(motoboy, c) for c in CAMPOS_DOMINIO}])
+
+    def remover(self, slug):
+        self._conexao().execute("DELETE FROM perfis WHERE slug = ?", (slug,))
+
+    def remover_id(self, motoboy_id):
+        # Devolve o slug removido (None se não estava na réplica)
+        conn = self._conexao()
+        row = conn.execute("SELECT slug FROM perfis WHERE id = ?", (str(motoboy_id),)).fetchone()
+        conn.execute("DELETE FROM perfis WHERE id = ?", (str(motoboy_id),))
+        return row[0] if row else None
+
+    def tem_foto(self, image_id):
+        return self._conexao().execute("SELECT 1 FROM perfis WHERE foto = ? LIMIT 1", (image_id,)).fetchone() is not None
+
+    def get_varios(self, slugs):
+        perfis = []
+        for i in range(0, len(slugs), 500):  # limite de parâmetros do SQLite
+            bloco = slugs[i:i + 500]
+            perfis += [Motoboy.from_directus(json.loads(row[0])) for row in self._conexao().execute(
+                f"SELECT dados FROM perfis WHERE slug IN ({','.join('?' * len(bloco))})", bloco)]
+        return perfis
+
+    def recentes(self, limite):
+        rows = self._conexao().execute("SELECT dados FROM perfis ORDER BY atualizado DESC LIMIT ?", (limite,))
+        return [Motoboy.from_directus(json.loads(row[0])) for row in rows]
+
+    def com_dominio(self):
+        rows = self._conexao().execute("SELECT dados FROM perfis WHERE dominio IS NOT NULL")
+        return [Motoboy.from_directus(json.loads(row[0])) for row in rows]
+
+    def _paginas(self, params):
+        pagina = 1
+        while True:
+            r = directus.get("/items/motoboys", params={
+                **params, "fields": campos(CAMPOS_DOMINIO + ('status',)), "limit": REPLICA_PAGE_SIZE, "page": pagina,
+            })
+            r.raise_for_status()
+            dados = r.json().get('data') or []
+            yield dados
+            if len(dados) < REPLICA_PAGE_SIZE:
+                return
+            pagina += 1
+
+    def carregar_todos(self):
+        inicio = time.time()
+        cursor = ''
+        total = 0
+        for dados in self._paginas({"sort": "id", "filter[status][_eq]": "published"}):
+            self.salvar_lote(dados, inicio)
+            cursor = max([cursor] + [carimbo(d) for d in dados])
+            total += len(dados)
+        conn = self._conexao()
+        # Tudo que não veio na carga foi apagado no Directus
+        apagados = conn.execute("SELECT id, slug, dominio FROM perfis WHERE salvo_em < ?", (inicio,)).fetchall()
+        conn.execute("DELETE FROM perfis WHERE salvo_em < ?", (inicio,))
+        for _, slug, _ in apagados:
+            remover_sos_estatico(slug)
+        if apagados:
+            invalidacoes.marcar([f"id:{mid}" for mid, _, _ in apagados] + [f"slug:{slug}" for _, slug, _ in apagados]
+                                + [f"host:{dominio}" for _, _, dominio in apagados if dominio])
+        self._set_meta('cursor', cursor)
+        self._set_meta('carga_completa_em', inicio)
+        self._set_meta('sincronizado_em', time.time())
+        metricas.inc("replica_sync_total", tipo="completa")
+        print(f"Réplica de perfis carregada: {total} registros.")
+
+    def sincronizar_delta(self):
+        cursor = self._meta('cursor', '')
+        params = {"sort": "date_updated"}
+        if cursor:
+            params["filter[_or][0][date_updated][_gt]"] = cursor
+            params["filter[_or][1][date_created][_gt]"] = cursor
+        novo_cursor = cursor
+        for dados in self._paginas(params):
+            self.salvar_lote(dados)
+            chaves = []
+            for d in dados:
+                novo_cursor = max(novo_cursor, carimbo(d))
+                chaves.append(f"id:{d.get('id')}")
+                if d.get('slug'):
+                    chaves.append(f"slug:{d['slug'].strip().lower()}")
+                if d.get('dominio_proprio'):
+                    chaves.append(f"host:{d['dominio_proprio'].strip().lower()}")
+                if d.get('status', 'published') != 'published':
+                    remover_sos_estatico(d.get('slug'))
+            if chaves:
+                # Só o líder roda o delta: a marca leva a mudança às caches de todos
+                invalidacoes.marcar(chaves)
+            metricas.inc("replica_rows_synced_total", len(dados))
+        self._set_meta('cursor', novo_cursor)
+        self._set_meta('sincronizado_em', time.time())
+        metricas.inc("replica_sync_total", tipo="delta")
+
+    def _loop_sincronizacao(self):
+        trava = open(self.caminho + ".lock", "w")
+        lider = False
+        while True:
+            if not lider:
+                try:
+                    fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    lider = True
+                except OSError:
+                    # Outro worker sincroniza; tenta de novo caso ele morra
+                    time.sleep(REPLICA_SYNC_INTERVAL)
+                    continue
+            try:
+                ultima_carga = float(self._meta('carga_completa_em', 0))
+                if time.time() - ultima_carga > REPLICA_FULL_INTERVAL:
+                    self.carregar_todos()
+                else:
+                    self.sincronizar_delta()
+            except Exception as e:
+                metricas.inc("replica_sync_errors_total")
+                print(f"Erro sincronizando réplica de perfis: {e}")
+            time.sleep(REPLICA_SYNC_INTERVAL)
+
+    def iniciar(self):
+        if not REPLICA_SYNC or self._pid_thread == os.getpid():
+            return
+        self._pid_thread = os.getpid()
+        threading.Thread(target=self._loop_sincronizacao, daemon=True).start()
+
+perfis_locais = PerfisLocais(PROFILE_STORE_PATH)
+refresh_executor = ExecutorPorProcesso(PROFILE_REFRESH_WORKERS, "perfis")
+
+# --- COALESCÊNCIA DE BUSCAS (SINGLE-FLIGHT) ---
+# Link do SOS compartilhado num grupo = dezenas de acessos ao mesmo slug no mesmo
+# instante. Misses concorrentes da mesma chave esperam uma única busca em andamento.
+# O líder busca na própria thread/greenlet (sem teto de buscas simultâneas de
+# chaves diferentes); só quando há cópia local e orçamento de tempo a busca vai
+# para refresh_executor, para o request poder desistir e servir a cópia.
+# Entre workers (opcional), um flock por chave serializa a busca e quem chega depois
+# relê a réplica compartilhada antes de ir ao Directus
+SINGLEFLIGHT_CROSS_WORKER = os.getenv("SINGLEFLIGHT_CROSS_WORKER", "0") == "1"
+SINGLEFLIGHT_LOCK_DIR = os.getenv("SINGLEFLIGHT_LOCK_DIR", "/tmp/motoboys_locks")
+SINGLEFLIGHT_LOCK_SLOTS = 256  # chaves são espalhadas num número fixo de arquivos
+SINGLEFLIGHT_LOCK_WAIT = float(os.getenv("SINGLEFLIGHT_LOCK_WAIT", 10))  # depois disso busca sem a trava
+
+class SingleFlight:
+    def __init__(self, executor):
+        self.executor = executor
+        self._voos = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def executar(self, chave, fn, *args, orcamento=None):
+        # Devolve o resultado de fn(*args), compartilhado entre chamadas simultâneas
+        # da mesma chave. Com orcamento (s), estoura TimeoutError se demorar mais
+        with self._lock:
+            if self._pid != os.getpid():
+                self._voos = {}
+                self._pid = os.getpid()
+            futuro = self._voos.get(chave)
+            lider = futuro is None
+            if lider:
+                futuro = self.executor.submit(fn, *args) if orcamento is not None else Future()
+                self._voos[chave] = futuro
+        if not lider:
+            metricas.inc("singleflight_requests_total", result="coalesced")
+            return futuro.result(timeout=orcamento)
+
+        metricas.inc("singleflight_requests_total", result="leader")
+        futuro.add_done_callback(lambda f: self._terminar(chave, f))
+        if orcamento is not None:
+            return futuro.result(timeout=orcamento)
+        try:
+            futuro.set_result(fn(*args))
+        except BaseException as e:
+            futuro.set_exception(e)
+        return futuro.result()
+
+    def _terminar(self, chave, futuro):
+        with self._lock:
+            if self._voos.get(chave) is futuro:
+                del self._voos[chave]
+
+em_voo = SingleFlight(refresh_executor)
+
+def _travar(trava, limite):
+    # flock bloqueante pararia o hub inteiro no gevent: tenta sem bloquear e dorme
+    # entre tentativas (time.sleep vira cooperativo com o monkey patch)
+    fim = time.monotonic() + limite
+    espera = 0.005
+    while True:
+        try:
+            fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if time.monotonic() >= fim:
+                return False
+            time.sleep(espera)
+            espera = min(espera * 2, 0.05)
+
+def coordenar_entre_workers(chave, releitura, fn, *args):
+    # releitura(desde) -> (achou, valor) com o que outro worker gravou após `desde`
+    if not SINGLEFLIGHT_CROSS_WORKER:
+        return fn(*args)
+    os.makedirs(SINGLEFLIGHT_LOCK_DIR, exist_ok=True)
+    slot = int(hashlib.md5(chave.encode()).hexdigest(), 16) % SINGLEFLIGHT_LOCK_SLOTS
+    inicio = time.time()
+    with open(os.path.join(SINGLEFLIGHT_LOCK_DIR, f"{slot}.lock"), "w") as trava:
+        if not _travar(trava, SINGLEFLIGHT_LOCK_WAIT):
+            metricas.inc("singleflight_lock_timeouts_total")
+            return fn(*args)
+        try:
+            achou, valor = releitura(inicio)
+            if achou:
+                metricas.inc("singleflight_requests_total", result="shared")
+                return valor
+            return fn(*args)
+        finally:
+            fcntl.flock(trava, fcntl.LOCK_UN)
+
+def _releitura_slug(slug):
+    def reler(desde):
+        local = perfis_locais.get(slug)
+        if local and local[1] >= desde:
+            profile_cache.set(slug, local[0])
+            return True, local[0]
+        return False, None
+    return reler
+
+def _releitura_dominio(host):
+    def reler(desde):
+        perfil = perfis_locais.get_dominio(host, desde)
+        return perfil is not None, perfil
+    return reler
+
+def buscar_perfil_directus(slug):
+    # Lê do Directus e atualiza cache em memória + réplica. None = slug livre ou só reservado
+    r = directus.get("/items/motoboys", params={
+        "filter[slug][_eq]": slug, "filter[status][_eq]": "published", "fields": campos(CAMPOS_DOMINIO), "limit": 1,
+    })
+    r.raise_for_status()
+    data = r.json().get('data')
+    if not data:
+        perfis_locais.remover(slug)
+        remover_sos_estatico(slug)
+        profile_cache.set(slug, None)
+        return None
+    motoboy = Motoboy.from_directus(data[0])
+    perfis_locais.salvar(motoboy)
+    profile_cache.set(slug, motoboy)
+    marcar_em_uso(motoboy)
+    return motoboy
+
+def buscar_dominio_directus(host):
+    r = directus.get("/items/motoboys", params={
+        "filter[dominio_proprio][_eq]": host, "filter[status][_eq]": "published", "fields": campos(CAMPOS_DOMINIO), "limit": 1,
+    })
+    r.raise_for_status()
+    data = r.json().get('data')
+    perfil = Motoboy.from_directus(data[0]) if data else None
+    if perfil is not None:
+        perfis_locais.salvar(perfil)
+    domain_map.set(host, perfil)
+    return perfil
+
+def obter_perfil(slug):
+    perfis_locais.iniciar()
+    achou, motoboy = profile_cache.get(slug)
+    if achou:
+        return motoboy
+
+    try:
+        local = perfis_locais.get(slug)
+    except Exception as e:
+        print(f"Erro lendo cópia local do perfil: {e}")
+        local = None
+    if perfis_locais.sincronizada():
+        motoboy = local[0] if local else None
+        profile_cache.set(slug, motoboy)
+        return motoboy
+    if local and time.time() - local[1] < PROFILE_FRESH_SECONDS:
+        profile_cache.set(slug, local[0])
+        return local[0]
+
+    # Com cópia local, o Directus tem um orçamento de tempo; sem ela, só resta esperar
+    try:
+        return em_voo.executar(
+            f"slug:{slug}", coordenar_entre_workers, f"slug:{slug}", _releitura_slug(slug), buscar_perfil_directus, slug,
+            orcamento=PROFILE_READ_BUDGET if local else None,
+        )
+    except Exception as e:
+        if not local:
+            raise
+        metricas.inc("profile_stale_served_total", motivo=type(e).__name__)
+        return local[0]
+
+# --- AQUECIMENTO DOS CACHES (WARM-UP) ---
+# Antes de atender, carrega o conjunto quente de perfis e os domínios próprios.
+# Com preload_app (gunicorn.conf.py) roda uma vez no master e os workers herdam
+# tudo por fork; sem preload, cada worker aquece em segundo plano. As chaves
+# quentes vêm do snapshot gravado pelos workers ao sair; sem snapshot, os perfis
+# editados mais recentemente. Dados vêm da réplica em dia ou do Directus em lote
+WARMUP = os.getenv("WARMUP", "True") == "True"
+WARMUP_MAX = int(os.getenv("WARMUP_MAX", 5000))
+WARMUP_SNAPSHOT_PATH = os.getenv("WARMUP_SNAPSHOT_PATH", "/tmp/motoboys_quentes.json")
+
+def ler_snapshot_quentes():
+    try:
+        with open(WARMUP_SNAPSHOT_PATH) as f:
+            return json.load(f).get('slugs') or []
+    except (FileNotFoundError, ValueError):
+        return []
+
+def salvar_snapshot_quentes():
+    # Chamado na saída de cada worker; junta com o que os outros já gravaram
+    slugs = [slug for slug, _ in profile_cache.itens()]
+    if not slugs: return
+    with open(WARMUP_SNAPSHOT_PATH + ".lock", "w") as trava:
+        fcntl.flock(trava, fcntl.LOCK_EX)
+        # Intercala com os anteriores: os mais recentes de cada worker ficam na frente
+        intercalados = [s for par in zip_longest(slugs, ler_snapshot_quentes()) for s in par if s]
+        juntos = list(dict.fromkeys(intercalados))[:WARMUP_MAX]
+        _escrever_atomico(WARMUP_SNAPSHOT_PATH, json.dumps({"slugs": juntos, "salvo_em": time.time()}).encode('utf-8'))
+
+def buscar_perfis_quentes(slugs):
+    params = {"filter[status][_eq]": "published", "fields": campos(CAMPOS_DOMINIO)}
+    registros = []
+    if slugs:
+        for i in range(0, len(slugs), 200):  # _in em blocos (tamanho da URL)
+            bloco = slugs[i:i + 200]
+            r = directus.get("/items/motoboys", params={**params, "filter[slug][_in]": ",".join(bloco), "limit": len(bloco)})
+            r.raise_for_status()
+            registros += r.json().get('data') or []
+    else:
+        pagina = 1
+        while len(registros) < WARMUP_MAX:
+            r = directus.get("/items/motoboys", params={
+                **params, "sort": "-date_updated", "limit": min(REPLICA_PAGE_SIZE, WARMUP_MAX - len(registros)), "page": pagina,
+            })
+            r.raise_for_status()
+            dados = r.json().get('data') or []
+            registros += dados
+            if len(dados) < REPLICA_PAGE_SIZE: break
+            pagina += 1
+    try:
+        perfis_locais.salvar_lote(registros)
+    except Exception as e:
+        print(f"Erro salvando perfis aquecidos na réplica: {e}")
+    return [Motoboy.from_directus(d) for d in registros]
+
+def aquecer_caches():
+    slugs = ler_snapshot_quentes()[:WARMUP_MAX]
+    if perfis_locais.sincronizada():
+        perfis = perfis_locais.get_varios(slugs) if slugs else perfis_locais.recentes(WARMUP_MAX)
+        for perfil in perfis_locais.com_dominio():
+            domain_map.set(perfil.dominio_proprio.strip().lower(), perfil)
+    else:
+        perfis = buscar_perfis_quentes(slugs)
+        if DOMAIN_PRELOAD:
+            domain_map.carregar_todos()
+    for perfil in perfis:
+        profile_cache.set(perfil.slug.lower(), perfil)
+        marcar_em_uso(perfil)
+    return len(perfis)
+
+class Aquecimento:
+    def __init__(self):
+        self.pronto = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def executar(self):
+        inicio = time.perf_counter()
+        try:
+            if WARMUP:
+                total = aquecer_caches()
+                print(f"Caches aquecidos: {total} perfis em {time.perf_counter() - inicio:.1f}s.")
+        except Exception as e:
+            # Sem Directus o app sobe frio, mas sobe
+            print(f"Erro no aquecimento dos caches: {e}")
+        finally:
+            self.pronto.set()
+
+    def iniciar(self):
+        # Sem preload_app: aquece este worker em segundo plano
+        if self.pronto.is_set() or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self.executar, daemon=True).start()
+
+aquecimento = Aquecimento()
+
+@app.route('/healthz')
+@classe_rota('api')
+def healthz():
+    return {"status": "ok"}
+
+@app.route('/readyz')
+@classe_rota('api')
+def readyz():
+    # Pronto só depois do aquecimento; o balanceador não manda tráfego antes
+    aquecimento.iniciar()
+    if not aquecimento.pronto.is_set():
+        return {"status": "aquecendo"}, 503
+    return {"status": "pronto"}
+
+# --- SENHAS ---
+# Hash de senha é CPU pura (scrypt/pbkdf2). Roda num pool limitado fora do worker
+# e, com o pool cheio, a requisição é recusada na hora em vez de enfileirar e
+# tirar CPU das páginas SOS. Limites valem por processo
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")  # ex.: scrypt:16384:8:1, pbkdf2:sha256:600000
+PASSWORD_POOL = os.getenv("PASSWORD_POOL", "thread")  # thread | process
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", 1))
+PASSWORD_POOL_QUEUE = int(os.getenv("PASSWORD_POOL_QUEUE", 4))
+PASSWORD_POOL_TIMEOUT = float(os.getenv("PASSWORD_POOL_TIMEOUT", 10))
+PASSWORD_POOL_NICE = int(os.getenv("PASSWORD_POOL_NICE", 10))  # só no modo process
+# Hashes em andamento somando todos os workers da máquina (0 = só o limite por processo)
+PASSWORD_POOL_GLOBAL = int(os.getenv("PASSWORD_POOL_GLOBAL", os.cpu_count() or 2))
+PASSWORD_POOL_LOCK_DIR = os.getenv("PASSWORD_POOL_LOCK_DIR", "/tmp/motoboys_senhas")
+
+class PoolSenhasCheio(Exception):
+    # Pool lotado ou hash que passou de PASSWORD_POOL_TIMEOUT: a rota responde 503
+    pass
+
+class VagasEntreProcessos:
+    # N arquivos de trava; cada hash em andamento segura um com flock não bloqueante.
+    # No modo sync cada worker atende um request por vez e o limite por processo
+    # nunca enche: este vale para a máquina toda, e o kernel solta a trava se o
+    # processo morrer
+    def __init__(self, diretorio, total):
+        self.diretorio = diretorio
+        self.total = total
+
+    def ocupar(self):
+        # Devolve a vaga (arquivo aberto e travado), None sem limite global, ou
+        # levanta PoolSenhasCheio
+        if not self.total: return None
+        os.makedirs(self.diretorio, exist_ok=True)
+        for i in range(self.total):
+            vaga = open(os.path.join(self.diretorio, f"{i}.lock"), "w")
+            try:
+                fcntl.flock(vaga, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return vaga
+            except OSError:
+                vaga.close()
+        metricas.inc("password_pool_rejections_total", escopo="global")
+        raise PoolSenhasCheio()
+
+    def liberar(self, vaga):
+        if vaga is not None:
+            vaga.close()  # fechar solta o flock
+
+vagas_senhas = VagasEntreProcessos(PASSWORD_POOL_LOCK_DIR, PASSWORD_POOL_GLOBAL)
+
+class PoolSenhas:
+    def __init__(self, modo, workers, fila):
+        self.modo = modo
+        self.workers = workers
+        self.fila = fila
+        self._executor = None
+        self._pid = None
+        self._pendentes = 0
+        self._lock = threading.Lock()
+
+    def _criar_executor(self):
+        if self.modo == 'process':
+            # spawn: o filho só importa o werkzeug, não herda threads nem o app
+            return ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=os.nice, initargs=(PASSWORD_POOL_NICE,),
+            )
+        if 'gevent' in sys.modules:
+            from gevent import monkey
+            if monkey.is_module_patched('threading'):
+                # Threads "normais" viram greenlets e travariam o loop durante o hash
+                from gevent.threadpool import ThreadPoolExecutor as ThreadPoolReal
+                return ThreadPoolReal(self.workers)
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="senhas")
+
+    def _concluir(self, vaga):
+        with self._lock:
+            self._pendentes -= 1
+        vagas_senhas.liberar(vaga)
+
+    def executar(self, fn, *args):
+        vaga = vagas_senhas.ocupar()
+        try:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = self._criar_executor()
+                    self._pid = os.getpid()
+                    self._pendentes = 0
+                if self._pendentes >= self.workers + self.fila:
+                    metricas.inc("password_pool_rejections_total", escopo="processo")
+                    raise PoolSenhasCheio()
+                futuro = self._executor.submit(fn, *args)
+                self._pendentes += 1
+        except Exception:
+            vagas_senhas.liberar(vaga)
+            raise
+        # A vaga só volta quando o hash termina, mesmo que o request desista antes
+        futuro.add_done_callback(lambda f: self._concluir(vaga))
+        try:
+            return futuro.result(timeout=PASSWORD_POOL_TIMEOUT)
+        except (FuturoTimeout, TimeoutError):
+            # A tarefa segue ocupando o pool até terminar (e conta em _pendentes)
+            metricas.inc("password_pool_timeouts_total")
+            raise PoolSenhasCheio()
+
+pool_senhas = PoolSenhas(PASSWORD_POOL, PASSWORD_POOL_WORKERS, PASSWORD_POOL_QUEUE)
+
+def prefixo_hash(metodo):
+    # "método:parâmetros" que o werkzeug grava antes do primeiro '$', com os
+    # mesmos padrões dele, sem calcular hash nenhum
+    nome, *args = metodo.split(':')
+    if nome == 'scrypt':
+        n, r, p = args or (2 ** 15, 8, 1)
+        return f"scrypt:{n}:{r}:{p}"
+    if nome == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iteracoes = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iteracoes}"
+    return metodo
+
+PREFIXO_HASH = prefixo_hash(PASSWORD_HASH_METHOD)
+
+def precisa_rehash(hash_senha):
+    # Compara "método:parâmetros" do hash salvo com o configurado hoje
+    return (hash_senha or '').split('$', 1)[0] != PREFIXO_HASH
+
+def gerar_hash_senha(senha):
+    inicio = time.perf_counter()
+    try:
+        return pool_senhas.executar(generate_password_hash, senha, PASSWORD_HASH_METHOD)
+    finally:
+        duracao = time.perf_counter() - inicio
+        metricas.observar("password_hash_duration_seconds", duracao, op="gerar")
+        registrar_tempo('hash', duracao)
+
+def verificar_senha(hash_senha, senha):
+    inicio = time.perf_counter()
+    try:
+        return pool_senhas.executar(check_password_hash, hash_senha, senha)
+    finally:
+        duracao = time.perf_counter() - inicio
+        metricas.observar("password_hash_duration_seconds", duracao, op="verificar")
+        registrar_tempo('hash', duracao)
+
+# Regravação de hash com executor próprio: não ocupa as threads de busca de perfis
+rehash_executor = ExecutorPorProcesso(1, "rehash")
+
+def rehash_senha(mid, senha):
+    # Login ok com hash de parâmetros antigos: regrava em segundo plano
+    try:
+        directus.patch(f"/items/motoboys/{mid}", json={"senha": gerar_hash_senha(senha)}).raise_for_status()
+        metricas.inc("password_rehash_total")
+    except Exception as e:
+        print(f"Erro regravando hash de senha: {e}")
+
 def calcular_idade(data_nasc):
     if not data_nasc: return ""
     try:
@@ -91,73 +1589,1044 @@ def calcular_idade(data_nasc):
     except:
         return ""
 
-def send_email(to_email, subject, html_body):
+# --- FILA DE E-MAILS ---
+# Envio fora do request: fila em memória + threads com conexão SMTP persistente
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", 1000))
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", 1))
+MAIL_MAX_RETRIES = int(os.getenv("MAIL_MAX_RETRIES", 5))
+MAIL_RETRY_BACKOFF = float(os.getenv("MAIL_RETRY_BACKOFF", 2))
+MAIL_IDLE_TIMEOUT = float(os.getenv("MAIL_IDLE_TIMEOUT", 60))
+MAIL_TIMEOUT = float(os.getenv("MAIL_TIMEOUT", 15))
+MAIL_SPOOL_DIR = os.getenv("MAIL_SPOOL_DIR", "")  # vazio = sem spool em disco
+
+def processo_vivo(pid):
     try:
-        msg = MIMEMultipart()
-        msg['From'] = MAIL_USERNAME
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(html_body, 'html'))
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class DespachanteEmail:
+    def __init__(self, spool_dir=""):
+        self.spool_dir = spool_dir
+        self._fila = queue.Queue(maxsize=MAIL_QUEUE_SIZE)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # Spool: um arquivo JSON por mensagem, com o pid do dono no nome
+    def _arquivo_spool(self, msg):
+        return os.path.join(self.spool_dir, f"{msg['id']}.{os.getpid()}.json")
+
+    def _gravar_spool(self, msg):
+        if not self.spool_dir: return
+        caminho = self._arquivo_spool(msg)
+        tmp = caminho + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(msg, f)
+        os.replace(tmp, caminho)
+
+    def _remover_spool(self, msg):
+        if not self.spool_dir: return
+        try:
+            os.remove(self._arquivo_spool(msg))
+        except FileNotFoundError:
+            pass
 
+    def _recuperar_spool(self):
+        # Assume mensagens deixadas por processos que já morreram (restart/deploy)
+        if not self.spool_dir: return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        for nome in os.listdir(self.spool_dir):
+            partes = nome.split('.')
+            if len(partes) != 3 or partes[2] != 'json' or not partes[1].isdigit():
+                continue
+            if int(partes[1]) == os.getpid() or processo_vivo(int(partes[1])):
+                continue
+            origem = os.path.join(self.spool_dir, nome)
+            destino = os.path.join(self.spool_dir, f"{partes[0]}.{os.getpid()}.json")
+            try:
+                os.rename(origem, destino)
+                with open(destino) as f:
+                    msg = json.load(f)
+                self._fila.put_nowait(msg)
+            except (FileNotFoundError, queue.Full):
+                continue
+            except Exception as e:
+                print(f"Erro recuperando e-mail do spool ({nome}): {e}")
+
+    def iniciar(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._recuperar_spool()
+            for _ in range(MAIL_WORKERS):
+                threading.Thread(target=self._worker, daemon=True).start()
+
+    def enfileirar(self, to_email, subject, html_body):
+        self.iniciar()
+        msg = {"id": uuid.uuid4().hex, "to": to_email, "subject": subject, "html": html_body, "tentativas": 0}
+        try:
+            self._gravar_spool(msg)
+            self._fila.put_nowait(msg)
+            metricas.inc("smtp_messages_total", result="enfileirado")
+            return True
+        except queue.Full:
+            self._remover_spool(msg)
+            print("Fila de e-mails cheia.")
+        except Exception as e:
+            print(f"Erro ao enfileirar email: {e}")
+        return False
+
+    def _conectar(self):
         if MAIL_USE_SSL:
-            server = smtplib.SMTP_SSL(MAIL_SERVER, MAIL_PORT)
+            server = smtplib.SMTP_SSL(MAIL_SERVER, MAIL_PORT, timeout=MAIL_TIMEOUT)
         else:
-            server = smtplib.SMTP(MAIL_SERVER, MAIL_PORT)
+            server = smtplib.SMTP(MAIL_SERVER, MAIL_PORT, timeout=MAIL_TIMEOUT)
             server.starttls()
-            
         server.login(MAIL_USERNAME, MAIL_PASSWORD)
-        server.sendmail(MAIL_USERNAME, to_email, msg.as_string())
-        server.quit()
-        return True
+        return server
+
+    def _montar(self, msg):
+        mime = MIMEMultipart()
+        mime['From'] = MAIL_USERNAME
+        mime['To'] = msg['to']
+        mime['Subject'] = msg['subject']
+        mime.attach(MIMEText(msg['html'], 'html'))
+        return mime.as_string()
+
+    def _fechar(self, server):
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+    def _reenfileirar(self, msg):
+        try:
+            self._fila.put_nowait(msg)
+        except queue.Full:
+            print(f"Fila cheia, e-mail para {msg['to']} mantido só no spool.")
+
+    def _worker(self):
+        server = None
+        while True:
+            try:
+                msg = self._fila.get(timeout=MAIL_IDLE_TIMEOUT)
+            except queue.Empty:
+                # Fecha a conexão ociosa; reabre no próximo envio
+                if server is not None:
+                    self._fechar(server)
+                    server = None
+                continue
+
+            try:
+                inicio = time.perf_counter()
+                if server is None:
+                    server = self._conectar()
+                server.sendmail(MAIL_USERNAME, msg['to'], self._montar(msg))
+                metricas.observar("smtp_send_duration_seconds", time.perf_counter() - inicio)
+                metricas.inc("smtp_messages_total", result="enviado")
+                self._remover_spool(msg)
+            except Exception as e:
+                print(f"Erro ao enviar email: {e}")
+                metricas.inc("smtp_messages_total", result="erro")
+                if server is not None:
+                    self._fechar(server)
+                    server = None
+                msg['tentativas'] += 1
+                if msg['tentativas'] < MAIL_MAX_RETRIES:
+                    self._gravar_spool(msg)
+                    espera = MAIL_RETRY_BACKOFF * (2 ** (msg['tentativas'] - 1))
+                    timer = threading.Timer(espera, self._reenfileirar, args=(msg,))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self._remover_spool(msg)
+                    print(f"E-mail para {msg['to']} descartado após {msg['tentativas']} tentativas.")
+
+mail_dispatcher = DespachanteEmail(MAIL_SPOOL_DIR)
+
+def send_email(to_email, subject, html_body):
+    # Só enfileira; o envio acontece em segundo plano
+    return mail_dispatcher.enfileirar(to_email, subject, html_body)
+
+# --- ASSETS ESTÁTICOS (CSS e ícones gerados por build_assets.py) ---
+ASSETS_DIST_DIR = os.path.join(app.static_folder, 'dist')
+ASSETS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def carregar_manifesto_assets():
+    try:
+        with open(os.path.join(ASSETS_DIST_DIR, 'manifest.json')) as f:
+            manifesto = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}, None
+    sprite = None
+    if manifesto.get('icons.svg'):
+        with open(os.path.join(ASSETS_DIST_DIR, manifesto['icons.svg']), encoding='utf-8') as f:
+            sprite = Markup(f.read())
+    return manifesto, sprite
+
+assets_manifest, assets_sprite = carregar_manifesto_assets()
+
+@app.template_global()
+def asset_url(nome):
+    # None quando o build não foi rodado: os templates caem no CDN
+    arquivo = assets_manifest.get(nome)
+    return f"{app.static_url_path}/dist/{arquivo}" if arquivo else None
+
+@app.template_global()
+def icon_sprite():
+    return assets_sprite
+
+assets_com_hash = {f"{app.static_url_path}/dist/{arquivo}" for arquivo in assets_manifest.values()}
+
+@app.after_request
+def cache_assets(resp):
+    # Arquivos com hash no nome nunca mudam: cache "eterno" no navegador/CDN.
+    # O manifest.json (nome fixo) fica com o cache padrão
+    if request.path in assets_com_hash and resp.status_code == 200:
+        resp.headers['Cache-Control'] = ASSETS_CACHE_CONTROL
+    return resp
+
+# --- CACHE HTTP DAS PÁGINAS PÚBLICAS ---
+# ETag forte a partir do registro + versão do template, e Cache-Control para CDN
+PUBLIC_CACHE_CONTROL = os.getenv("PUBLIC_CACHE_CONTROL", "public, max-age=60, stale-while-revalidate=600, stale-if-error=86400")
+
+def _versao_template_sos():
+    # Template + assets: trocar o CSS/ícones também muda a página
+    h = hashlib.sha256()
+    for nome in ('sos.html', '_assets.html'):
+        with open(os.path.join(app.root_path, 'templates', nome), 'rb') as f:
+            h.update(f.read())
+    h.update(json.dumps(assets_manifest, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()[:12]
+
+SOS_TEMPLATE_VERSION = os.getenv("SOS_TEMPLATE_VERSION") or _versao_template_sos()
+
+def etag_perfil(m, idade):
+    # A idade entra no hash porque muda no aniversário sem o registro mudar
+    base = f"{m.id}|{m.date_updated or m.date_created}|{m.foto_url}|{idade}|{SOS_TEMPLATE_VERSION}"
+    return hashlib.sha256(base.encode('utf-8')).hexdigest()[:20]
+
+def responder_perfil(m, etag, gerar, mimetype='text/html'):
+    # Revalidação só pelo ETag: ele inclui template, assets e idade, que mudam sem
+    # mexer no date_updated (por isso não há Last-Modified). Comparação fraca
+    # porque a versão comprimida sai com W/"etag"
+    if request.if_none_match.contains_weak(etag):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(gerar())
+        resp.mimetype = mimetype
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = PUBLIC_CACHE_CONTROL
+    resp.headers['X-SOS-Perfil'] = '1'  # o service worker só guarda o que tem esta marca
+    return resp
+
+def responder_sos(m):
+    idade = calcular_idade(m.data_nascimento)
+    return responder_perfil(m, etag_perfil(m, idade), lambda: render_template('sos.html', m=m, idade=idade))
+
+# Representações enxutas só com os dados de emergência (apps, leitores offline)
+def dados_emergencia(m):
+    contatos = [
+        {"nome": nome or '', "telefone": tel}
+        for nome, tel in ((m.contato_nome, m.contato_telefone), (m.contato_nome2, m.contato_telefone2)) if tel
+    ]
+    return {
+        "slug": m.slug,
+        "nome": m.nome_completo,
+        "idade": calcular_idade(m.data_nascimento) or None,
+        "tipo_sanguineo": m.tipo_sanguineo,
+        "alergias_condicoes": m.alergias_condicoes,
+        "plano_saude": m.plano_saude,
+        "contatos": contatos,
+        "atualizado_em": m.date_updated or m.date_created,
+    }
+
+def _vcard_texto(valor):
+    return str(valor or '').replace('\\', '\\\\').replace('\n', '\\n').replace(',', '\\,').replace(';', '\\;')
+
+def vcard_emergencia(m):
+    d = dados_emergencia(m)
+    nota = [f"Tipo sanguíneo: {d['tipo_sanguineo'] or '-'}", f"Alergias/condições: {d['alergias_condicoes'] or '-'}",
+            f"Plano de saúde: {d['plano_saude'] or '-'}"]
+    nota += [f"Contato de emergência: {c['nome']} {c['telefone']}" for c in d['contatos']]
+    linhas = ["BEGIN:VCARD", "VERSION:3.0", f"FN:{_vcard_texto(d['nome'])}", f"N:;{_vcard_texto(d['nome'])};;;"]
+    for i, c in enumerate(d['contatos'], 1):
+        linhas.append(f"item{i}.TEL;TYPE=CELL:{_vcard_texto(c['telefone'])}")
+        linhas.append(f"item{i}.X-ABLABEL:{_vcard_texto('Emergência ' + c['nome'])}")
+    linhas += [f"NOTE:{_vcard_texto(chr(10).join(nota))}", f"URL:{PUBLIC_BASE_URL}/{m.slug}", "END:VCARD"]
+    return "\r\n".join(linhas) + "\r\n"
+
+FORMATOS_EMERGENCIA = {
+    'json': ('application/json', lambda m: json.dumps(dados_emergencia(m), ensure_ascii=False)),
+    'vcf': ('text/vcard', vcard_emergencia),
+}
+
+def responder_emergencia(slug, formato):
+    mimetype, gerar = FORMATOS_EMERGENCIA[formato]
+    slug = slug.lower().strip()
+    try:
+        m = obter_perfil(slug)
     except Exception as e:
-        print(f"Erro ao enviar email: {e}")
-        return False
+        print(f"Erro ao carregar perfil {slug}: {e}")
+        return {"erro": "Erro ao carregar perfil."}, 503, {'Retry-After': '5'}
+    if m is None:
+        return {"erro": "Perfil não encontrado."}, 404
+    etag = f"{etag_perfil(m, calcular_idade(m.data_nascimento))}-{formato}"
+    resp = responder_perfil(m, etag, lambda: gerar(m), mimetype)
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
 
-# --- SEGURANÇA: MIDDLEWARE ANTI-BOT ---
+# --- RENDERIZAÇÃO ESTÁTICA DAS PÁGINAS SOS ---
+# Gera o HTML de cada perfil em disco quando o motoboy salva os dados;
+# a rota pública só envia o arquivo, sem Directus nem Jinja
+STATIC_RENDER = os.getenv("STATIC_RENDER", "False") == "True"
+STATIC_RENDER_DIR = os.getenv("STATIC_RENDER_DIR", os.path.join(app.root_path, "render"))
+
+def _escrever_atomico(caminho, conteudo):
+    tmp = f"{caminho}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(conteudo)
+    os.replace(tmp, caminho)
+
+def proximo_aniversario(data_nasc):
+    # Dia em que a idade exibida muda (ISO); None sem data de nascimento válida
+    try:
+        nascimento = datetime.strptime(data_nasc, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+    hoje = date.today()
+    for ano in (hoje.year, hoje.year + 1):
+        try:
+            aniversario = nascimento.replace(year=ano)
+        except ValueError:
+            aniversario = date(ano, 3, 1)  # 29/02 em ano não bissexto: calcular_idade vira em 01/03
+        if aniversario > hoje:
+            return aniversario.isoformat()
+
+def _manifesto_sos(slug):
+    return os.path.join(STATIC_RENDER_DIR, f"{slug}.json")
+
+def renderizar_sos_estatico(motoboy):
+    slug = (motoboy.slug or '').lower()
+    if not slug: return None
+
+    # Fora de um request (CLI, threads) o Jinja precisa de um contexto
+    with app.test_request_context('/'):
+        html = render_template('sos.html', m=motoboy, idade=calcular_idade(motoboy.data_nascimento))
+    dados = html.encode('utf-8')
+    impressao = hashlib.sha256(dados).hexdigest()[:16]
+    nome = f"{slug}.{impressao}.html"
+
+    os.makedirs(STATIC_RENDER_DIR, exist_ok=True)
+    caminho = os.path.join(STATIC_RENDER_DIR, nome)
+    _escrever_atomico(caminho, dados)
+    _escrever_atomico(caminho + '.gz', gzip.compress(dados, 9))
+    if brotli is not None:
+        _escrever_atomico(caminho + '.br', brotli.compress(dados, quality=11))
+
+    try:
+        with open(_manifesto_sos(slug)) as f:
+            anterior = json.load(f).get('arquivo')
+    except (FileNotFoundError, ValueError):
+        anterior = None
+
+    # Versão do template/assets e validade da idade: fora disso o arquivo não é servido
+    manifesto = {"arquivo": nome, "etag": impressao, "id": motoboy.id, "gerado_em": time.time(),
+                 "versao": SOS_TEMPLATE_VERSION, "idade_ate": proximo_aniversario(motoboy.data_nascimento)}
+    _escrever_atomico(_manifesto_sos(slug), json.dumps(manifesto).encode('utf-8'))
+
+    # Remove a versão anterior deste slug
+    if anterior and anterior != nome:
+        for sufixo in ('', '.gz', '.br'):
+            try:
+                os.remove(os.path.join(STATIC_RENDER_DIR, anterior + sufixo))
+            except FileNotFoundError:
+                pass
+    return nome
+
+def remover_sos_estatico(slug):
+    # Perfil apagado ou despublicado: a página não pode continuar saindo do disco.
+    # O manifesto sai primeiro, e a rota pública deixa de achar o arquivo
+    slug = (slug or '').strip().lower()
+    if not slug: return
+    try:
+        with open(_manifesto_sos(slug)) as f:
+            arquivo = json.load(f).get('arquivo')
+    except FileNotFoundError:
+        return
+    except ValueError:
+        arquivo = None
+    caminhos = [_manifesto_sos(slug)]
+    if arquivo:
+        caminhos += [os.path.join(STATIC_RENDER_DIR, arquivo + sufixo) for sufixo in ('', '.gz', '.br')]
+    for caminho in caminhos:
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+
+def atualizar_sos_estatico(motoboy):
+    if not STATIC_RENDER: return
+    try:
+        renderizar_sos_estatico(motoboy)
+    except Exception as e:
+        print(f"Erro renderizando SOS estático: {e}")
+
+def responder_sos_dinamico(motoboy):
+    # Arquivo estático ausente ou velho: responde pelo Jinja e regrava em segundo plano
+    if STATIC_RENDER:
+        refresh_executor.submit(atualizar_sos_estatico, motoboy)
+    return responder_sos(motoboy)
+
+def servir_sos_estatico(slug):
+    # Devolve a resposta com o arquivo pré-renderizado, ou None se não existir ou
+    # estiver desatualizado (outro deploy do template/assets ou idade que já mudou)
+    try:
+        with open(_manifesto_sos(slug)) as f:
+            manifesto = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if manifesto.get('versao') != SOS_TEMPLATE_VERSION:
+        return None
+    if manifesto.get('idade_ate') and date.today().isoformat() >= manifesto['idade_ate']:
+        return None
+
+    caminho = os.path.join(STATIC_RENDER_DIR, manifesto['arquivo'])
+    etag = manifesto['etag']
+    disponiveis = [c for c, ext in (('br', '.br'), ('gzip', '.gz')) if os.path.exists(caminho + ext)]
+    codificacao = escolher_codificacao(request.headers.get('Accept-Encoding', ''), disponiveis)
+
+    arquivo = caminho + {'br': '.br', 'gzip': '.gz'}.get(codificacao, '')
+    if not os.path.exists(arquivo):
+        return None
+    resp = send_file(arquivo, mimetype='text/html', etag=f"{etag}-{codificacao}" if codificacao else etag,
+                     conditional=True, max_age=0)
+    if codificacao:
+        resp.headers['Content-Encoding'] = codificacao
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Cache-Control'] = PUBLIC_CACHE_CONTROL
+    resp.headers['X-SOS-Perfil'] = '1'
+    return resp
+
+@app.cli.command("render-all")
+@click.option("--page-size", default=200, help="Itens por página na leitura do Directus.")
+def render_all(page_size):
+    """Renderiza a página SOS estática de todos os motoboys."""
+    pagina, total = 1, 0
+    while True:
+        r = directus.get("/items/motoboys", params={
+            "filter[status][_eq]": "published",
+            "fields": campos(CAMPOS_SOS), "limit": page_size, "page": pagina, "sort": "id",
+        })
+        r.raise_for_status()
+        data = r.json().get('data') or []
+        if not data: break
+        for dados in data:
+            if renderizar_sos_estatico(Motoboy.from_directus(dados)):
+                total += 1
+        pagina += 1
+    click.echo(f"{total} páginas SOS renderizadas em {STATIC_RENDER_DIR}")
+
+# --- PROVISIONAMENTO DE ADESIVOS EM LOTE ---
+# Reserva slugs de uma tiragem de adesivos como registros "draft" (sem dono).
+# O slug reservado continua levando ao cadastro, que assume o registro.
+# Valida com _in em blocos, cria com POST em lote (array) e vários lotes em
+# paralelo; o progresso sai como eventos (CLI ou ndjson) e o resultado num
+# manifesto CSV com a URL que vai no QR de cada adesivo
+PROVISION_TOKEN = os.getenv("PROVISION_TOKEN", "")
+PROVISION_BATCH_SIZE = int(os.getenv("PROVISION_BATCH_SIZE", 500))
+PROVISION_CHECK_SIZE = int(os.getenv("PROVISION_CHECK_SIZE", 200))  # slugs por consulta _in (tamanho da URL)
+PROVISION_CONCURRENCY = int(os.getenv("PROVISION_CONCURRENCY", 4))
+PROVISION_MAX = int(os.getenv("PROVISION_MAX", 20000))
+PROVISION_MANIFEST_DIR = os.getenv("PROVISION_MANIFEST_DIR", "manifestos")
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", f"https://{SYSTEM_DOMAINS[0]}")
+
+RE_SLUG = re.compile(r'^[a-z0-9][a-z0-9-]{2,39}$')
+ROTAS_RESERVADAS = {'static', 'img', 'cadastro', 'login', 'logout', 'painel', 'esqueceu-senha',
+                    'redefinir-senha', 'metrics', 'webhooks', 'api', 'favicon.ico', 'sw.js', 'healthz', 'readyz'}
+ALFABETO_SLUG = "23456789abcdefghjkmnpqrstuvwxyz"  # sem 0/o, 1/i/l: o adesivo é lido a olho
+
+TAMANHO_SLUG_GERADO = 6
+RE_PREFIXO_SLUG = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+
+def normalizar_prefixo(prefixo):
+    # Prefixo em minúsculas que ainda gera slug válido (RE_SLUG); None se não servir
+    prefixo = (prefixo or '').strip().lower()
+    if not prefixo:
+        return ''
+    if not RE_PREFIXO_SLUG.match(prefixo) or len(prefixo) + TAMANHO_SLUG_GERADO > 40:
+        return None
+    return prefixo
+
+def gerar_slugs(quantidade, prefixo='', tamanho=TAMANHO_SLUG_GERADO):
+    return [prefixo + ''.join(secrets.choice(ALFABETO_SLUG) for _ in range(tamanho)) for _ in range(quantidade)]
+
+def slugs_existentes(slugs):
+    existentes = set()
+    for i in range(0, len(slugs), PROVISION_CHECK_SIZE):
+        bloco = slugs[i:i + PROVISION_CHECK_SIZE]
+        r = directus.get("/items/motoboys", params={
+            "filter[slug][_in]": ",".join(bloco), "fields": "slug", "limit": len(bloco),
+        })
+        r.raise_for_status()
+        existentes.update((d.get('slug') or '').lower() for d in r.json().get('data') or [])
+    return existentes
+
+def _criar_reservas(slugs):
+    # POST em lote; se outro processo pegou algum slug no meio, tira os ocupados e tenta de novo
+    for tentativa in range(2):
+        r = directus.post("/items/motoboys", json=[{"status": "draft", "slug": s} for s in slugs],
+                          params={"fields": "id,slug"})
+        if r.status_code in [200, 201]:
+            return r.json().get('data') or []
+        if tentativa == 0 and r.status_code == 400:
+            ocupados = slugs_existentes(slugs)
+            slugs = [s for s in slugs if s not in ocupados]
+            if not slugs: return []
+            continue
+        r.raise_for_status()
+    return []
+
+def provisionar_adesivos(slugs=None, quantidade=0, prefixo=''):
+    """Gera eventos de progresso (dicts); o último traz o resumo e o manifesto."""
+    prefixo = normalizar_prefixo(prefixo)
+    if prefixo is None:
+        raise ValueError("prefixo inválido")
+    resultado = {}  # slug -> (status, id)
+    candidatos = []
+    for slug in dict.fromkeys((s or '').strip().lower() for s in slugs or []):
+        if RE_SLUG.match(slug) and slug not in ROTAS_RESERVADAS:
+            candidatos.append(slug)
+        elif slug:
+            resultado[slug] = ('invalido', None)
+
+    # Slugs informados: os já existentes são recusados. Gerados: sorteia de novo
+    existentes = slugs_existentes(candidatos)
+    for slug in existentes:
+        resultado[slug] = ('em_uso', None)
+    livres = [s for s in candidatos if s not in existentes]
+    vistos = set(candidatos)
+    gerados = []
+    for _ in range(5):
+        faltam = quantidade - len(gerados)
+        if faltam <= 0: break
+        novos = [s for s in dict.fromkeys(gerar_slugs(faltam, prefixo)) if s not in vistos]
+        vistos.update(novos)
+        ocupados = slugs_existentes(novos)
+        gerados += [s for s in novos if s not in ocupados]
+    livres += gerados
+    yield {"fase": "validacao", "livres": len(livres), "recusados": len(resultado)}
+
+    lotes = [livres[i:i + PROVISION_BATCH_SIZE] for i in range(0, len(livres), PROVISION_BATCH_SIZE)]
+    feitos = 0
+    with ThreadPoolExecutor(max_workers=PROVISION_CONCURRENCY, thread_name_prefix="adesivos") as executor:
+        futuros = {executor.submit(_criar_reservas, lote): lote for lote in lotes}
+        for futuro in as_completed(futuros):
+            lote = futuros[futuro]
+            try:
+                criados = {(d.get('slug') or '').lower(): d.get('id') for d in futuro.result()}
+                erro = None
+            except Exception as e:
+                criados, erro = {}, str(e)
+            for slug in lote:
+                resultado[slug] = ('reservado', criados[slug]) if slug in criados else ('erro' if erro else 'em_uso', None)
+            feitos += len(lote)
+            metricas.inc("stickers_reserved_total", len(criados))
+            evento = {"fase": "criacao", "feitos": feitos, "total": len(livres)}
+            if erro: evento["erro"] = erro
+            yield evento
+
+    os.makedirs(PROVISION_MANIFEST_DIR, exist_ok=True)
+    nome = f"adesivos-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.csv"
+    with open(os.path.join(PROVISION_MANIFEST_DIR, nome), 'w', newline='', encoding='utf-8') as f:
+        saida = csv.writer(f)
+        saida.writerow(["slug", "url", "id", "status"])
+        for slug, (status, mid) in resultado.items():
+            saida.writerow([slug, f"{PUBLIC_BASE_URL}/{slug}", mid or '', status])
+
+    resumo = {}
+    for status, _ in resultado.values():
+        resumo[status] = resumo.get(status, 0) + 1
+    yield {"fase": "concluido", "resumo": resumo, "manifesto": nome}
+
+@app.cli.command("provisionar-adesivos")
+@click.option("--quantidade", default=0, help="Quantos slugs aleatórios gerar.")
+@click.option("--prefixo", default="", help="Prefixo dos slugs gerados.")
+@click.option("--arquivo", type=click.File("r"), help="Arquivo com um slug por linha.")
+def provisionar_adesivos_cli(quantidade, prefixo, arquivo):
+    """Reserva slugs de adesivos em lote e grava o manifesto CSV."""
+    if normalizar_prefixo(prefixo) is None:
+        raise click.BadParameter(f"use letras minúsculas, números e '-', até {40 - TAMANHO_SLUG_GERADO} caracteres.",
+                                 param_hint="--prefixo")
+    slugs = arquivo.read().split() if arquivo else []
+    for evento in provisionar_adesivos(slugs, quantidade, prefixo):
+        if evento["fase"] == "criacao":
+            click.echo(f"\r{evento['feitos']}/{evento['total']} reservados", nl=False)
+        elif evento["fase"] == "concluido":
+            click.echo(f"\n{evento['resumo']} -> {os.path.join(PROVISION_MANIFEST_DIR, evento['manifesto'])}")
+        else:
+            click.echo(f"{evento['livres']} slugs livres, {evento['recusados']} recusados")
+
+def _autorizado_provisionar():
+    if not PROVISION_TOKEN: abort(404)
+    if not segredo_confere(request.headers.get('Authorization'), f"Bearer {PROVISION_TOKEN}"): abort(403)
+
+@app.route('/api/adesivos/lote', methods=['POST'])
+@classe_rota('api')
+def api_provisionar_adesivos():
+    _autorizado_provisionar()
+    erro = {"erro": f"Envie 'slugs' (lista de textos) e/ou 'quantidade', no máximo {PROVISION_MAX} no total."}, 400
+    corpo = request.get_json(silent=True) or {}
+    if not isinstance(corpo, dict): return erro
+    slugs = corpo.get('slugs') or []
+    try:
+        quantidade = int(corpo.get('quantidade') or 0)
+    except (TypeError, ValueError):
+        return erro
+    if (not isinstance(slugs, list) or not all(isinstance(s, str) for s in slugs)
+            or quantidade < 0 or len(slugs) + quantidade > PROVISION_MAX):
+        return erro
+    prefixo = normalizar_prefixo(str(corpo.get('prefixo') or ''))
+    if prefixo is None:
+        return {"erro": f"'prefixo' aceita letras minúsculas, números e '-', até {40 - TAMANHO_SLUG_GERADO} caracteres."}, 400
+    eventos = provisionar_adesivos(slugs, quantidade, prefixo)
+    return app.response_class((json.dumps(e) + "\n" for e in eventos), mimetype='application/x-ndjson')
+
+@app.route('/api/adesivos/manifesto/<nome>')
+@classe_rota('api')
+def api_manifesto_adesivos(nome):
+    _autorizado_provisionar()
+    caminho = os.path.join(PROVISION_MANIFEST_DIR, secure_filename(nome))
+    if not os.path.isfile(caminho): abort(404)
+    return send_file(os.path.abspath(caminho), mimetype='text/csv', as_attachment=True)
+
+# --- PROXY DE IMAGENS ---
+# Busca a foto no Directus uma vez, gera miniaturas quadradas por tamanho/formato
+# e guarda tudo num cache em disco limitado (LRU por mtime)
+IMG_CACHE_DIR = os.getenv("IMG_CACHE_DIR", "/tmp/motoboys_img")
+IMG_CACHE_MAX_BYTES = int(os.getenv("IMG_CACHE_MAX_MB", 512)) * 1024 * 1024
+IMG_SIZES = (64, 128, 256, 512)
+IMG_QUALITY = int(os.getenv("IMG_QUALITY", 70))
+IMG_CACHE_RESCAN = int(os.getenv("IMG_CACHE_RESCAN", 500))  # gravações entre varreduras do diretório
+IMG_CACHE_CONTROL = "public, max-age=31536000, immutable"
+RE_ID_ARQUIVO = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+# formato -> (extensão, mimetype, nome no Pillow)
+IMG_FORMATOS = {
+    'avif': ('avif', 'image/avif', 'AVIF'),
+    'webp': ('webp', 'image/webp', 'WEBP'),
+    'jpeg': ('jpg', 'image/jpeg', 'JPEG'),
+}
+
+PLACEHOLDER_SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 128 128">'
+    '<rect width="128" height="128" fill="#e5e7eb"/>'
+    '<circle cx="64" cy="50" r="22" fill="#9ca3af"/>'
+    '<path d="M24 112c4-22 20-34 40-34s36 12 40 34z" fill="#9ca3af"/>'
+    '</svg>'
+)
+
+class CacheImagens:
+    # Total em bytes mantido a cada gravação; a varredura do diretório (stat de todos
+    # os arquivos) só roda em segundo plano, quando passa do limite ou a cada
+    # IMG_CACHE_RESCAN gravações, para somar o que os outros workers gravaram
+    def __init__(self, diretorio, max_bytes):
+        self.diretorio = diretorio
+        self.max_bytes = max_bytes
+        self._total = None  # desconhecido até a primeira varredura
+        self._gravacoes = 0
+        self._varrendo = False
+        self._lock = threading.Lock()
+
+    def _caminho(self, nome):
+        return os.path.join(self.diretorio, nome)
+
+    def ler(self, nome):
+        caminho = self._caminho(nome)
+        try:
+            with open(caminho, 'rb') as f:
+                dados = f.read()
+            os.utime(caminho)  # marca como usado recentemente
+            metricas.inc("cache_requests_total", cache="imagens", result="hit")
+            return dados
+        except FileNotFoundError:
+            metricas.inc("cache_requests_total", cache="imagens", result="miss")
+            return None
+
+    def gravar(self, nome, dados):
+        os.makedirs(self.diretorio, exist_ok=True)
+        _escrever_atomico(self._caminho(nome), dados)
+        with self._lock:
+            self._gravacoes += 1
+            if self._total is not None:
+                self._total += len(dados)
+            varrer = not self._varrendo and (
+                self._total is None or self._total > self.max_bytes or self._gravacoes % IMG_CACHE_RESCAN == 0
+            )
+            if varrer:
+                self._varrendo = True
+        if varrer:
+            threading.Thread(target=self._despejar, daemon=True).start()
+
+    def _despejar(self):
+        try:
+            arquivos = []
+            total = 0
+            for entrada in os.scandir(self.diretorio):
+                if entrada.is_file():
+                    st = entrada.stat()
+                    arquivos.append((st.st_mtime, st.st_size, entrada.path))
+                    total += st.st_size
+            if total > self.max_bytes:
+                # Remove os menos usados até ficar em 90% do limite
+                for _, tamanho, caminho in sorted(arquivos):
+                    if total <= self.max_bytes * 0.9:
+                        break
+                    try:
+                        os.remove(caminho)
+                        total -= tamanho
+                    except FileNotFoundError:
+                        pass
+            with self._lock:
+                self._total = total
+        except Exception as e:
+            print(f"Erro limpando cache de imagens: {e}")
+        finally:
+            with self._lock:
+                self._varrendo = False
+
+img_cache = CacheImagens(IMG_CACHE_DIR, IMG_CACHE_MAX_BYTES)
+
+# Formatos que o Pillow instalado consegue gravar (AVIF depende da versão/plugin)
+if Image is not None:
+    Image.init()
+    IMG_PIL_SAVE = set(Image.SAVE)
+else:
+    IMG_PIL_SAVE = set()
+
+def _formato_imagem():
+    # Checagem literal: '*/*' não significa que o navegador decodifica AVIF/WebP
+    aceitos = request.headers.get('Accept', '')
+    if 'image/avif' in aceitos and 'AVIF' in IMG_PIL_SAVE:
+        return 'avif'
+    if 'image/webp' in aceitos and 'WEBP' in IMG_PIL_SAVE:
+        return 'webp'
+    return 'jpeg'
+
+def _tamanho_imagem(pedido):
+    for tamanho in IMG_SIZES:
+        if pedido <= tamanho:
+            return tamanho
+    return IMG_SIZES[-1]
+
+def _mimetype_original(dados):
+    if dados[:3] == b'\xff\xd8\xff': return 'image/jpeg'
+    if dados[:8] == b'\x89PNG\r\n\x1a\n': return 'image/png'
+    if dados[:4] == b'RIFF' and dados[8:12] == b'WEBP': return 'image/webp'
+    if dados[:6] in (b'GIF87a', b'GIF89a'): return 'image/gif'
+    return 'application/octet-stream'
+
+def gerar_miniatura(original, tamanho, formato):
+    img = Image.open(io.BytesIO(original))
+    img = ImageOps.exif_transpose(img)
+    img = ImageOps.fit(img, (tamanho, tamanho), Image.LANCZOS)
+    if formato == 'jpeg' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    saida = io.BytesIO()
+    # Sem exif=: metadados (GPS etc.) não vão para a miniatura
+    img.save(saida, IMG_FORMATOS[formato][2], quality=IMG_QUALITY)
+    return saida.getvalue()
+
+def foto_publicada(image_id):
+    # O proxy busca com o token admin: só repassa arquivos que são a foto de um
+    # motoboy publicado, nunca um arquivo qualquer do Directus
+    perfis_locais.iniciar()
+    try:
+        if perfis_locais.tem_foto(image_id):
+            return True
+        if perfis_locais.sincronizada():
+            return False
+    except Exception as e:
+        print(f"Erro consultando foto na réplica: {e}")
+    r = directus.get("/items/motoboys", params={
+        "filter[foto][_eq]": image_id, "filter[status][_eq]": "published", "fields": "id", "limit": 1,
+    })
+    r.raise_for_status()
+    return bool(r.json().get('data'))
+
+def buscar_original(image_id):
+    nome = f"{image_id}.orig"
+    original = img_cache.ler(nome)
+    if original is None:
+        if not foto_publicada(image_id):
+            metricas.inc("img_proxy_denied_total")
+            return None
+        r = directus.get(f"/assets/{image_id}")
+        if r.status_code != 200:
+            return None
+        original = r.content
+        img_cache.gravar(nome, original)
+    return original
+
+@app.route('/img/placeholder.svg')
+@classe_rota('static')
+def imagem_placeholder():
+    resp = make_response(PLACEHOLDER_SVG)
+    resp.mimetype = 'image/svg+xml'
+    resp.headers['Cache-Control'] = 'public, max-age=86400'
+    return resp
+
+@app.route('/img/<image_id>')
+@classe_rota('static')
+def imagem(image_id):
+    if not RE_ID_ARQUIVO.match(image_id):
+        abort(404)
+
+    tamanho = _tamanho_imagem(request.args.get('s', 256, type=int))
+    formato = _formato_imagem()
+    if Image is None:
+        # Sem Pillow: repassa o original, ainda com cache em disco e headers imutáveis
+        nome = f"{image_id}.orig"
+    else:
+        nome = f"{image_id}_{tamanho}.{IMG_FORMATOS[formato][0]}"
+
+    if request.if_none_match.contains(nome):
+        resp = make_response('', 304)
+    else:
+        dados = img_cache.ler(nome)
+        if dados is None:
+            try:
+                original = buscar_original(image_id)
+                if original is None:
+                    return redirect('/img/placeholder.svg')
+                dados = original
+                if Image is not None:
+                    dados = gerar_miniatura(original, tamanho, formato)
+                    img_cache.gravar(nome, dados)
+            except Exception as e:
+                print(f"Erro gerando imagem {image_id}: {e}")
+                return redirect('/img/placeholder.svg')
+        resp = make_response(dados)
+        resp.mimetype = IMG_FORMATOS[formato][1] if Image is not None else _mimetype_original(dados)
+
+    resp.set_etag(nome)
+    resp.headers['Cache-Control'] = IMG_CACHE_CONTROL
+    resp.headers['Vary'] = 'Accept'
+    return resp
+
+# --- INSTRUMENTAÇÃO DE REQUESTS ---
 @app.before_request
+def iniciar_medicao():
+    g.inicio_request = time.perf_counter()
+    metricas.iniciar()
+
+@app.after_request
+def registrar_medicao(resp):
+    inicio = g.get('inicio_request')
+    if inicio is None:
+        return resp
+    duracao = time.perf_counter() - inicio
+    rota = request.url_rule.rule if request.url_rule else 'nao_encontrada'
+    metricas.observar("http_request_duration_seconds", duracao, route=rota, method=request.method)
+    metricas.inc("http_requests_total", route=rota, method=request.method, status=resp.status_code)
+    if SERVER_TIMING:
+        partes = [f"app;dur={duracao * 1000:.1f}"]
+        for etapa, (total, n) in g.get('tempos', {}).items():
+            partes.append(f'{etapa};dur={total * 1000:.1f};desc="{n}x"')
+        resp.headers['Server-Timing'] = ', '.join(partes)
+    return resp
+
+@before_render_template.connect_via(app)
+def _inicio_render(sender, template, context, **extra):
+    g.inicio_render = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _fim_render(sender, template, context, **extra):
+    inicio = g.pop('inicio_render', None)
+    if inicio is not None:
+        duracao = time.perf_counter() - inicio
+        metricas.observar("template_render_duration_seconds", duracao, template=template.name)
+        registrar_tempo('render', duracao)
+
+@app.route('/metrics')
+@classe_rota('api')
+def metrics():
+    if METRICS_TOKEN and not segredo_confere(request.headers.get('Authorization'), f"Bearer {METRICS_TOKEN}"):
+        abort(401)
+    resp = make_response(metricas.exportar())
+    resp.mimetype = 'text/plain'
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+# --- COMPRESSÃO DE RESPOSTAS ---
+# br/gzip negociado pelo Accept-Encoding. Respostas públicas com ETag são
+# comprimidas uma vez (nível máximo) e os bytes ficam em cache por ETag;
+# o resto é comprimido a cada resposta com nível rápido
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "True") == "True"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_CACHE_SIZE = int(os.getenv("COMPRESS_CACHE_SIZE", 2000))
+COMPRESS_MIMETYPES = frozenset((
+    'text/html', 'text/css', 'text/plain', 'text/vcard', 'text/csv', 'application/json',
+    'application/javascript', 'image/svg+xml',
+))
+compress_cache = CacheMemoria(COMPRESS_CACHE_SIZE, PROFILE_CACHE_TTL * 12, 0, nome="compressao")
+
+def escolher_codificacao(accept_encoding, disponiveis=None):
+    # q=0 recusa a codificação; br só com o módulo brotli instalado ou, para
+    # arquivos já comprimidos, só as codificações em `disponiveis`
+    if disponiveis is None:
+        disponiveis = ('br', 'gzip') if brotli is not None else ('gzip',)
+    aceitas = {}
+    for parte in accept_encoding.lower().split(','):
+        nome, _, params = parte.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        aceitas[nome.strip()] = q
+    for codificacao in ('br', 'gzip'):
+        if codificacao in disponiveis and aceitas.get(codificacao, 0) > 0:
+            return codificacao
+    return None
+
+def comprimir(dados, codificacao, maximo):
+    if codificacao == 'br':
+        return brotli.compress(dados, quality=11 if maximo else 4)
+    return gzip.compress(dados, compresslevel=9 if maximo else 6, mtime=0)
+
+@app.after_request
+def comprimir_resposta(resp):
+    if resp.status_code == 304:
+        # Revalidação de uma versão comprimida: devolve a mesma ETag fraca
+        etag, _ = resp.get_etag()
+        if etag and request.if_none_match.is_weak(etag):
+            resp.set_etag(etag, weak=True)
+        return resp
+    if not COMPRESS_ENABLED or request.method == 'HEAD' or resp.status_code != 200:
+        return resp
+    if resp.direct_passthrough or resp.is_streamed or 'Content-Encoding' in resp.headers:
+        return resp
+    if resp.mimetype not in COMPRESS_MIMETYPES:
+        return resp
+    resp.vary.add('Accept-Encoding')
+    codificacao = escolher_codificacao(request.headers.get('Accept-Encoding', ''))
+    dados = resp.get_data()
+    if not codificacao or len(dados) < COMPRESS_MIN_SIZE:
+        return resp
+
+    inicio = time.perf_counter()
+    etag, fraca = resp.get_etag()
+    cacheavel = etag and 'public' in resp.headers.get('Cache-Control', '')
+    comprimido = None
+    if cacheavel:
+        _, comprimido = compress_cache.get(f"{etag}|{codificacao}")
+    if comprimido is None:
+        comprimido = comprimir(dados, codificacao, bool(cacheavel))
+        if cacheavel:
+            compress_cache.set(f"{etag}|{codificacao}", comprimido)
+    duracao = time.perf_counter() - inicio
+    metricas.observar("compression_duration_seconds", duracao, encoding=codificacao)
+    metricas.inc("compression_saved_bytes_total", len(dados) - len(comprimido), encoding=codificacao)
+    registrar_tempo('compressao', duracao)
+
+    resp.set_data(comprimido)
+    resp.headers['Content-Encoding'] = codificacao
+    if etag:
+        # Mesmo conteúdo, bytes diferentes: ETag fraca (como o gzip do nginx)
+        resp.set_etag(etag, weak=True)
+    return resp
+
+# --- SEGURANÇA: MIDDLEWARE ANTI-BOT ---
+# Uma passada só sobre o UA já em minúsculas (re.IGNORECASE sai ~8x mais lento)
+RE_BOTS = re.compile(r'python-requests|curl|wget|libwww-perl|scrapy|httpclient')
+
 def block_scrapers():
-    user_agent = request.headers.get('User-Agent', '').lower()
-    bots = ['python-requests', 'curl', 'wget', 'libwww-perl', 'scrapy', 'httpclient']
-    if any(bot in user_agent for bot in bots):
+    if RE_BOTS.search(request.environ.get('HTTP_USER_AGENT', '').lower()):
         abort(403, description="Acesso negado.")
 
 # --- MIDDLEWARE: VERIFICA DOMÍNIO PRÓPRIO ---
-@app.before_request
+# Só nas rotas marcadas com dominio=True (a home, que vira SOS no domínio próprio)
 def verificar_dominio():
     host_atual = request.host.split(':')[0].lower()
-    g.perfil_dominio = None
-    
-    e_sistema = False
-    for sys_d in SYSTEM_DOMAINS:
-        if sys_d in host_atual:
-            e_sistema = True
-            break
-            
-    if not e_sistema:
-        try:
-            headers = get_headers()
-            url = f"{DIRECTUS_URL}/items/motoboys?filter[dominio_proprio][_eq]={host_atual}&limit=1"
-            r = requests.get(url, headers=headers)
-            data = r.json().get('data')
-            
-            if data:
-                usuario = data[0]
-                usuario['foto_url'] = get_img_url(usuario.get('foto'))
-                g.perfil_dominio = usuario
-        except Exception as e:
-            print(f"Erro verificando domínio: {e}")
+    if e_dominio_sistema(host_atual):
+        return
+
+    perfis_locais.iniciar()
+    if not REPLICA_SYNC:
+        domain_map.iniciar()
+    achou, perfil = domain_map.get(host_atual)
+    if achou:
+        g.perfil_dominio = perfil
+        return
+
+    try:
+        if perfis_locais.sincronizada():
+            g.perfil_dominio = perfis_locais.get_dominio(host_atual)
+            domain_map.set(host_atual, g.perfil_dominio)
+            return
+    except Exception as e:
+        print(f"Erro lendo domínio na réplica: {e}")
+
+    try:
+        chave = f"dominio:{host_atual}"
+        g.perfil_dominio = em_voo.executar(
+            chave, coordenar_entre_workers, chave, _releitura_dominio(host_atual), buscar_dominio_directus, host_atual
+        )
+    except Exception as e:
+        print(f"Erro verificando domínio: {e}")
+
+# --- PIPELINE DE MIDDLEWARES ---
+MIDDLEWARES_POR_CLASSE = {
+    'public': (block_scrapers,),
+    'auth': (block_scrapers,),
+    'dashboard': (block_scrapers,),
+    'static': (),
+    'api': (),  # protegidas por token; clientes legítimos usam curl/requests
+}
+_pipelines = {}
+
+def pipeline_do_endpoint(endpoint):
+    # Montado uma vez por endpoint; 404 (endpoint None) cai na classe public
+    etapas = _pipelines.get(endpoint)
+    if etapas is None:
+        etapas = MIDDLEWARES_POR_CLASSE[CLASSE_POR_ENDPOINT.get(endpoint, 'public')]
+        if endpoint in ENDPOINTS_COM_DOMINIO:
+            etapas = etapas + (verificar_dominio,)
+        _pipelines[endpoint] = etapas
+    return etapas
+
+@app.before_request
+def executar_middlewares():
+    for etapa in pipeline_do_endpoint(request.endpoint):
+        resp = etapa()
+        if resp is not None:
+            return resp
 
 # --- ROTA RAIZ (HOME) ---
 @app.route('/')
+@classe_rota('public', dominio=True)
 def index():
-    if g.perfil_dominio:
-        return render_template('sos.html', m=g.perfil_dominio, idade=calcular_idade(g.perfil_dominio.get('data_nascimento')))
+    if g.get('perfil_dominio'):
+        if STATIC_RENDER:
+            resp = servir_sos_estatico((g.perfil_dominio.slug or '').lower())
+            if resp: return resp
+        return responder_sos_dinamico(g.perfil_dominio)
     if session.get('motoboy_id'):
         return redirect('/painel')
     return render_template('index.html')
 
 # --- CADASTRO ---
 @app.route('/cadastro', methods=['GET', 'POST'])
+@classe_rota('auth')
 def cadastro():
     # Rate Limit: 10 cadastros por hora por IP
     if not check_limit(f"cad_{get_ip()}", 10, 3600):
@@ -172,42 +2641,76 @@ def cadastro():
         email = request.form.get('email').strip()
         senha = request.form.get('senha')
         
-        headers = get_headers()
-        
-        check_slug = requests.get(f"{DIRECTUS_URL}/items/motoboys?filter[slug][_eq]={slug}", headers=headers)
-        if check_slug.status_code == 200 and len(check_slug.json()['data']) > 0:
-            flash('Este código de adesivo já está em uso!', 'error')
+        try:
+            em_uso, reserva_id = verificar_disponibilidade(slug, email)
+        except Exception as e:
+            print(f"Erro verificando disponibilidade do cadastro: {e}")
+            flash('Erro de conexão.', 'error')
             return render_template('cadastro.html', codigo=slug)
 
-        check_email = requests.get(f"{DIRECTUS_URL}/items/motoboys?filter[email][_eq]={email}", headers=headers)
-        if check_email.status_code == 200 and len(check_email.json()['data']) > 0:
+        if em_uso == 'slug':
+            flash('Este código de adesivo já está em uso!', 'error')
+            return render_template('cadastro.html', codigo=slug)
+        if em_uso == 'email':
             flash('Este e-mail já está cadastrado!', 'error')
             return render_template('cadastro.html', codigo=slug)
 
+        try:
+            hash_senha = gerar_hash_senha(senha)
+        except PoolSenhasCheio:
+            flash('Muitos acessos no momento. Tente novamente em instantes.', 'error')
+            return render_template('cadastro.html', codigo=slug), 503
+
         payload = {
             "status": "published",
             "slug": slug,
             "nome_completo": nome,
             "email": email,
-            "senha": generate_password_hash(senha)
+            "senha": hash_senha
         }
 
         try:
-            r = requests.post(f"{DIRECTUS_URL}/items/motoboys", headers=headers, json=payload)
-            if r.status_code in [200, 201]:
-                motoboy_id = r.json()['data']['id']
-                session['motoboy_id'] = motoboy_id
+            if reserva_id:
+                # Adesivo provisionado em lote: assume o registro só se ainda for
+                # reserva (update por query). Entre a checagem e aqui passa o tempo
+                # do hash; num cadastro simultâneo do mesmo adesivo, o segundo não
+                # sobrescreve e-mail e senha do primeiro
+                r = directus.patch("/items/motoboys", json={
+                    "query": {"filter": {"id": {"_eq": reserva_id}, "status": {"_eq": "draft"}}},
+                    "data": payload,
+                }, params={"fields": campos(CAMPOS_PAINEL)})
+                assumidos = (r.json().get('data') or []) if r.status_code == 200 else None
+                if assumidos == []:
+                    flash('Este código de adesivo já está em uso!', 'error')
+                    return render_template('cadastro.html', codigo=slug)
+                dados = assumidos[0] if assumidos else None
+            else:
+                r = directus.post("/items/motoboys", json=payload, params={"fields": campos(CAMPOS_PAINEL)})
+                dados = r.json()['data'] if r.status_code in [200, 201] else None
+            if dados:
+                motoboy = Motoboy.from_directus(dados)
+                marcar_em_uso(motoboy)
+                try:
+                    perfis_locais.salvar(motoboy)
+                except Exception as e:
+                    print(f"Erro salvando cópia local do perfil: {e}")
+                # Derruba o cache negativo do slug em todos os workers
+                invalidar_perfil(mid=motoboy.id, slug=slug)
+                atualizar_sos_estatico(motoboy)
+                session['motoboy_id'] = motoboy.id
                 flash('Cadastro realizado! Preencha seus dados.', 'success')
                 return redirect('/painel')
             else:
                 flash(f'Erro ao cadastrar: {r.text}', 'error')
         except Exception as e:
+            print(f"Erro ao cadastrar: {e}")
             flash('Erro de conexão.', 'error')
 
     return render_template('cadastro.html', codigo=codigo_pre)
 
 # --- LOGIN ---
 @app.route('/login', methods=['GET', 'POST'])
+@classe_rota('auth')
 def login():
     # Rate Limit: 10 tentativas por minuto
     if not check_limit(f"login_{get_ip()}", 10, 60):
@@ -218,12 +2721,19 @@ def login():
         email = request.form.get('email').strip()
         senha = request.form.get('senha')
         
-        headers = get_headers()
-        r = requests.get(f"{DIRECTUS_URL}/items/motoboys?filter[email][_eq]={email}", headers=headers)
+        r = directus.get("/items/motoboys", params={"filter[email][_eq]": email, "fields": campos(CAMPOS_AUTH), "limit": 1})
         data = r.json().get('data')
         
-        if data and check_password_hash(data[0]['senha'], senha):
+        try:
+            ok = bool(data) and verificar_senha(data[0]['senha'], senha)
+        except PoolSenhasCheio:
+            flash('Muitos acessos no momento. Tente novamente em instantes.', 'error')
+            return render_template('login.html'), 503
+
+        if ok:
             session['motoboy_id'] = data[0]['id']
+            if precisa_rehash(data[0]['senha']):
+                rehash_executor.submit(rehash_senha, data[0]['id'], senha)
             return redirect('/painel')
         else:
             flash('E-mail ou senha incorretos.', 'error')
@@ -232,12 +2742,12 @@ def login():
 
 # --- ESQUECEU SENHA ---
 @app.route('/esqueceu-senha', methods=['GET', 'POST'])
+@classe_rota('auth')
 def esqueceu_senha():
     if request.method == 'POST':
         email = request.form.get('email').strip()
-        headers = get_headers()
         
-        r = requests.get(f"{DIRECTUS_URL}/items/motoboys?filter[email][_eq]={email}", headers=headers)
+        r = directus.get("/items/motoboys", params={"filter[email][_eq]": email, "fields": "email,nome_completo", "limit": 1})
         data = r.json().get('data')
         
         if data:
@@ -264,6 +2774,7 @@ def esqueceu_senha():
 
 # --- REDEFINIR SENHA ---
 @app.route('/redefinir-senha/<token>', methods=['GET', 'POST'])
+@classe_rota('auth')
 def redefinir_senha(token):
     try:
         email = serializer.loads(token, salt='recuperar-senha', max_age=3600)
@@ -273,29 +2784,117 @@ def redefinir_senha(token):
         
     if request.method == 'POST':
         nova_senha = request.form.get('senha')
-        headers = get_headers()
         
-        r = requests.get(f"{DIRECTUS_URL}/items/motoboys?filter[email][_eq]={email}", headers=headers)
+        r = directus.get("/items/motoboys", params={"filter[email][_eq]": email, "fields": "id", "limit": 1})
         data = r.json().get('data')
         
         if data:
             user_id = data[0]['id']
-            payload = {"senha": generate_password_hash(nova_senha)}
-            requests.patch(f"{DIRECTUS_URL}/items/motoboys/{user_id}", headers=headers, json=payload)
+            try:
+                payload = {"senha": gerar_hash_senha(nova_senha)}
+            except PoolSenhasCheio:
+                flash('Muitos acessos no momento. Tente novamente em instantes.', 'error')
+                return render_template('redefinir_senha.html', token=token), 503
+            directus.patch(f"/items/motoboys/{user_id}", json=payload)
             
             flash('Senha alterada com sucesso! Faça login.', 'success')
             return redirect('/login')
             
     return render_template('redefinir_senha.html', token=token)
 
+def perfil_atualizado(mid, motoboy):
+    # Chamado após qualquer PATCH bem-sucedido no registro do motoboy.
+    # Grava a réplica antes de marcar a invalidação: quem reler depois já acha a nova
+    painel_cache.invalidar(str(mid))
+    try:
+        perfis_locais.salvar(motoboy)
+    except Exception as e:
+        print(f"Erro salvando cópia local do perfil: {e}")
+    invalidar_perfil(mid=mid, slug=motoboy.slug, host=motoboy.dominio_proprio)
+    atualizar_sos_estatico(motoboy)
+
+def retirar_perfil(mid):
+    # Motoboy apagado ou despublicado: sai da réplica, das caches e do disco
+    slug = None
+    try:
+        slug = perfis_locais.remover_id(mid)
+    except Exception as e:
+        print(f"Erro removendo cópia local do perfil: {e}")
+    invalidar_perfil(mid=mid, slug=slug)
+    remover_sos_estatico(slug)
+
+@app.route('/webhooks/directus', methods=['POST'])
+@classe_rota('api')
+def webhook_directus():
+    # Flow do Directus (items.create/update/delete em motoboys) -> réplica local
+    if not DIRECTUS_WEBHOOK_SECRET: abort(404)
+    if not segredo_confere(request.headers.get('X-Webhook-Secret'), DIRECTUS_WEBHOOK_SECRET): abort(403)
+    evento = request.get_json(silent=True) or {}
+    if evento.get('collection', 'motoboys') != 'motoboys':
+        return "", 204
+    ids = [str(k) for k in (evento.get('keys') or [evento.get('key')]) if k]
+    if not ids:
+        return "", 204
+
+    if str(evento.get('event', '')).endswith('delete'):
+        for mid in ids:
+            retirar_perfil(mid)
+        return "", 204
+
+    r = directus.get("/items/motoboys", params={
+        "filter[id][_in]": ",".join(ids), "fields": campos(CAMPOS_DOMINIO + ('status',)), "limit": len(ids),
+    })
+    r.raise_for_status()
+    encontrados = {str(d.get('id')): d for d in r.json().get('data') or [] if d.get('status') == 'published'}
+    for mid in ids:
+        if mid in encontrados:
+            perfil_atualizado(mid, Motoboy.from_directus(encontrados[mid]))
+        else:
+            retirar_perfil(mid)
+    return "", 204
+
+@app.errorhandler(413)
+def upload_grande_demais(e):
+    # Só o painel recebe foto; nas outras rotas (API, webhook) é um 413 comum
+    if request.endpoint != 'painel':
+        return e
+    flash(f"Arquivo muito grande. Limite de {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB.", 'error')
+    return redirect('/painel')
+
 # --- PAINEL ---
+def registro_painel(mid):
+    # Cópia local só vale se for a mesma versão que esta sessão viu por último
+    achou, user = painel_cache.get(str(mid))
+    if achou and versao_registro(user) == session.get('painel_versao'):
+        return user
+    return None
+
+def guardar_registro_painel(mid, user):
+    painel_cache.set(str(mid), user)
+    session['painel_versao'] = versao_registro(user)
+
+# Campo no Directus -> nome no formulário do painel
+CAMPOS_FORMULARIO_PAINEL = {
+    "nome_completo": "nome", "email": "email", "data_nascimento": "nascimento", "tipo_sanguineo": "sangue",
+    "alergias_condicoes": "alergias", "contato_nome": "contato_nome", "contato_telefone": "contato_tel",
+    "contato_nome2": "contato_nome2", "contato_telefone2": "contato_tel2", "plano_saude": "plano",
+    "dominio_proprio": "dominio_proprio",
+}
+
+def originais_formulario():
+    # Valores que o formulário exibiu (campo oculto); None em formulário antigo/inválido
+    try:
+        originais = json.loads(request.form.get('originais') or 'null')
+    except ValueError:
+        return None
+    return originais if isinstance(originais, dict) else None
+
 @app.route('/painel', methods=['GET', 'POST'])
+@classe_rota('dashboard')
 def painel():
     mid = session.get('motoboy_id')
     if not mid: return redirect('/login')
     
-    headers = get_headers()
-    
     if request.method == 'POST':
         dom_proprio = request.form.get('dominio_proprio', '').replace('http://', '').replace('https://', '').rstrip('/')
         
@@ -305,7 +2904,7 @@ def painel():
         tel_principal = request.form.get('contato_tel', '')
         tel_secundario = request.form.get('contato_tel2', '')
 
-        payload = {
+        formulario = {
             "nome_completo": request.form.get('nome'),
             "email": request.form.get('email'),
             "data_nascimento": nascimento,
@@ -318,62 +2917,102 @@ def painel():
             "plano_saude": request.form.get('plano'),
             "dominio_proprio": dom_proprio
         }
-        
+
+        # Manda só o que o motoboy mudou em relação ao que o formulário exibiu: uma
+        # edição feita em outro lugar nesse meio tempo não é sobrescrita
+        originais = originais_formulario()
+        if originais is None:
+            payload = formulario
+        else:
+            payload = {
+                k: v for k, v in formulario.items()
+                if CAMPOS_FORMULARIO_PAINEL[k] in request.form and (originais.get(k) or '') != (v or '')
+            }
         f = request.files.get('foto')
-        if f and f.filename:
-            fid = upload_file(f)
-            if fid: 
-                payload['foto'] = fid
+
+        if payload:
+            r = directus.patch(f"/items/motoboys/{mid}", json=payload, params={"fields": campos(CAMPOS_PAINEL)})
+            ok = r.status_code in [200, 201]
+        else:
+            ok = True
+            metricas.inc("painel_patch_skipped_total")
+
+        if ok:
+            if payload:
+                dados = r.json()['data']
+                perfil_atualizado(mid, Motoboy.from_directus(dados))
+                guardar_registro_painel(mid, Motoboy.from_directus(dados, 128))
+
+            if f and f.filename:
+                try:
+                    agendar_foto(mid, f)
+                    flash('Dados atualizados! Sua foto está sendo processada.', 'success')
+                except Exception as e:
+                    print(f"Erro Upload: {e}")
+                    flash('Os dados foram salvos, mas ocorreu um erro com a foto.', 'error')
             else:
-                flash('Os dados foram salvos, mas ocorreu um erro com a foto.', 'error')
-            
-        r = requests.patch(f"{DIRECTUS_URL}/items/motoboys/{mid}", headers=headers, json=payload)
-        
-        if r.status_code in [200, 201]:
-            flash('Dados atualizados com sucesso!', 'success')
+                flash('Dados atualizados com sucesso!', 'success')
         else:
             flash('Erro ao salvar. Verifique os campos.', 'error')
             
         return redirect('/painel')
 
     # GET
-    r = requests.get(f"{DIRECTUS_URL}/items/motoboys/{mid}", headers=headers)
-    if r.status_code != 200: return redirect('/logout')
-    
-    user = r.json()['data']
-    user['foto_url'] = get_img_url(user.get('foto'))
-    
-    return render_template('painel.html', user=user)
+    user = registro_painel(mid)
+    if user is None:
+        r = directus.get(f"/items/motoboys/{mid}", params={"fields": campos(CAMPOS_PAINEL)})
+        if r.status_code != 200: return redirect('/logout')
+        user = Motoboy.from_directus(r.json()['data'], 128)
+        guardar_registro_painel(mid, user)
+
+    originais = {k: getattr(user, k) for k in CAMPOS_FORMULARIO_PAINEL}
+    return render_template('painel.html', user=user, originais=originais)
 
 # --- LOGOUT ---
 @app.route('/logout')
+@classe_rota('auth')
 def logout():
     session.clear()
     return redirect('/')
 
+@app.route('/sw.js')
+@classe_rota('static')
+def service_worker():
+    # Na raiz para o escopo cobrir /<slug>; no-cache para atualizações chegarem logo
+    resp = send_file(os.path.join(app.static_folder, 'sw.js'), mimetype='application/javascript', max_age=0)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+@app.route('/<slug>.json')
+@classe_rota('public')
+def perfil_json(slug):
+    return responder_emergencia(slug, 'json')
+
+@app.route('/<slug>.vcf')
+@classe_rota('public')
+def perfil_vcf(slug):
+    return responder_emergencia(slug, 'vcf')
+
 # --- ROTA PÚBLICA (SOS por Slug) ---
 @app.route('/<slug>')
+@classe_rota('public')
 def perfil_publico(slug):
     slug = slug.lower().strip()
     if slug in ['static', 'favicon.ico']: return ""
 
-    headers = get_headers()
-    url = f"{DIRECTUS_URL}/items/motoboys?filter[slug][_eq]={slug}&limit=1"
-    
+    if STATIC_RENDER:
+        resp = servir_sos_estatico(slug)
+        if resp: return resp
+
     try:
-        r = requests.get(url, headers=headers)
-        data = r.json().get('data')
-        
-        if not data:
-            return redirect(f'/cadastro?codigo={slug}')
-            
-        motoboy = data[0]
-        motoboy['foto_url'] = get_img_url(motoboy.get('foto'))
-        
-        return render_template('sos.html', m=motoboy, idade=calcular_idade(motoboy.get('data_nascimento')))
-        
+        motoboy = obter_perfil(slug)
     except Exception as e:
-        return "Erro ao carregar perfil."
+        print(f"Erro ao carregar perfil {slug}: {e}")
+        return "Erro ao carregar perfil.", 503, {'Retry-After': '5'}
+
+    if motoboy is None:
+        return redirect(f'/cadastro?codigo={slug}')
+    return responder_sos_dinamico(motoboy)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
@@ -0,0 +1,250 @@
+"""Directus falso para benchmarks locais.
+
+Implementa só o que o app usa de /items/motoboys (filtros _eq/_in/_nempty/_gt/_or,
+fields, limit, page, sort, POST simples e em lote, PATCH por id e por query), /files e /assets,
+com latência e taxa de erro configuráveis. GET /__stats devolve a contagem de
+chamadas por rota; POST /__reset zera os contadores.
+
+    python bench/fake_directus.py --port 8055 --riders 5000 --latency-ms 80 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from werkzeug.security import generate_password_hash
+
+SENHA_PADRAO = "senha123"
+RE_FILTRO = re.compile(r'^filter((?:\[[^\]]+\])+)$')
+
+def _png_1x1():
+    # PNG 1x1 cinza: suficiente para o proxy de imagens
+    def bloco(tipo, dados):
+        return struct.pack('>I', len(dados)) + tipo + dados + struct.pack('>I', zlib.crc32(tipo + dados))
+    ihdr = struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + bloco(b'IHDR', ihdr) + bloco(b'IDAT', zlib.compress(b'\x00\x80')) + bloco(b'IEND', b'')
+
+PNG_1X1 = _png_1x1()
+
+class Banco:
+    def __init__(self, riders, dominios):
+        self.lock = threading.Lock()
+        self.itens = {}
+        self.proximo_id = 1
+        self.stats = Counter()
+        senha = generate_password_hash(SENHA_PADRAO)
+        agora = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        for i in range(riders):
+            self.inserir({
+                "status": "published",
+                "slug": f"moto{i}",
+                "email": f"moto{i}@bench.local",
+                "senha": senha,
+                "nome_completo": f"Motoboy {i}",
+                "data_nascimento": "1990-05-17",
+                "tipo_sanguineo": "O+",
+                "alergias_condicoes": "Alérgico a dipirona",
+                "contato_nome": "Contato",
+                "contato_telefone": "11999999999",
+                "plano_saude": "SUS",
+                "dominio_proprio": f"moto{i}.bench.local" if i < dominios else "",
+                "foto": None,
+                "date_created": agora,
+                "date_updated": agora,
+            })
+
+    def inserir(self, dados):
+        item = dict(dados)
+        item['id'] = self.proximo_id
+        item.setdefault('date_created', time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()))
+        self.itens[item['id']] = item
+        self.proximo_id += 1
+        return item
+
+def _condicao(item, campo, operador, valor):
+    atual = item.get(campo)
+    if operador == '_eq': return str(atual) == valor if atual is not None else valor == 'null'
+    if operador == '_neq': return str(atual) != valor
+    if operador == '_in': return str(atual) in valor.split(',')
+    if operador == '_nempty': return bool(atual)
+    if operador == '_empty': return not atual
+    if operador == '_null': return atual is None
+    if operador == '_nnull': return atual is not None
+    if operador == '_gt': return atual is not None and str(atual) > valor
+    if operador == '_gte': return atual is not None and str(atual) >= valor
+    return True
+
+def filtrar(itens, query):
+    simples, ors = [], {}
+    for chave, valores in query.items():
+        m = RE_FILTRO.match(chave)
+        if not m: continue
+        partes = re.findall(r'\[([^\]]+)\]', m.group(1))
+        if partes[0] == '_or':
+            ors.setdefault(partes[1], []).append((partes[2], partes[3], valores[0]))
+        else:
+            simples.append((partes[0], partes[1], valores[0]))
+    res = []
+    for item in itens:
+        if not all(_condicao(item, c, o, v) for c, o, v in simples): continue
+        if ors and not any(all(_condicao(item, c, o, v) for c, o, v in grupo) for grupo in ors.values()): continue
+        res.append(item)
+    return res
+
+def projetar(item, fields):
+    if not fields or fields == '*': return item
+    return {c: item.get(c) for c in fields.split(',')}
+
+def criar_handler(banco, latencia, jitter, taxa_erro):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _resposta(self, status, corpo, tipo='application/json'):
+            dados = corpo if isinstance(corpo, bytes) else json.dumps(corpo).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', tipo)
+            self.send_header('Content-Length', str(len(dados)))
+            self.end_headers()
+            self.wfile.write(dados)
+
+        def _corpo(self):
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                partes = []
+                while True:
+                    tamanho = int(self.rfile.readline().strip(), 16)
+                    if tamanho == 0:
+                        self.rfile.readline()
+                        break
+                    partes.append(self.rfile.read(tamanho))
+                    self.rfile.readline()
+                return b''.join(partes)
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        def _simular(self, rota):
+            banco.stats[rota] += 1
+            if latencia or jitter:
+                time.sleep((latencia + random.uniform(0, jitter)) / 1000)
+            if taxa_erro and random.random() < taxa_erro:
+                banco.stats['erros_injetados'] += 1
+                self._resposta(503, {"errors": [{"message": "erro injetado"}]})
+                return False
+            return True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/__stats':
+                return self._resposta(200, dict(banco.stats))
+            if url.path.startswith('/assets/'):
+                if self._simular('GET /assets'):
+                    self._resposta(200, PNG_1X1, 'image/png')
+                return
+            m = re.match(r'^/items/motoboys/(\d+)$', url.path)
+            if m:
+                if not self._simular('GET /items/motoboys/:id'): return
+                with banco.lock:
+                    item = banco.itens.get(int(m.group(1)))
+                if not item:
+                    return self._resposta(403, {"errors": [{"message": "forbidden"}]})
+                return self._resposta(200, {"data": projetar(item, query.get('fields', [''])[0])})
+            if url.path == '/items/motoboys':
+                if not self._simular('GET /items/motoboys'): return
+                with banco.lock:
+                    itens = list(banco.itens.values())
+                res = filtrar(itens, query)
+                sort = query.get('sort', [''])[0]
+                if sort:
+                    campo = sort.lstrip('-')
+                    res.sort(key=lambda i: (i.get(campo) is None, i.get(campo)), reverse=sort.startswith('-'))
+                limite = int(query.get('limit', ['100'])[0])
+                pagina = int(query.get('page', ['1'])[0])
+                if limite >= 0:
+                    res = res[(pagina - 1) * limite: pagina * limite]
+                fields = query.get('fields', [''])[0]
+                return self._resposta(200, {"data": [projetar(i, fields) for i in res]})
+            self._resposta(404, {"errors": [{"message": "not found"}]})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            corpo = self._corpo()
+            if url.path == '/__reset':
+                banco.stats.clear()
+                return self._resposta(200, {})
+            if url.path == '/files':
+                if self._simular('POST /files'):
+                    self._resposta(200, {"data": {"id": "00000000-0000-4000-8000-%012d" % len(corpo)}})
+                return
+            if url.path == '/items/motoboys':
+                if not self._simular('POST /items/motoboys'): return
+                dados = json.loads(corpo or b'{}')
+                fields = parse_qs(url.query).get('fields', [''])[0]
+                with banco.lock:
+                    lote = dados if isinstance(dados, list) else [dados]
+                    slugs = {i.get('slug') for i in banco.itens.values()}
+                    if any(d.get('slug') in slugs for d in lote):
+                        return self._resposta(400, {"errors": [{"message": "slug duplicado"}]})
+                    criados = [banco.inserir(d) for d in lote]
+                res = [projetar(i, fields) for i in criados]
+                return self._resposta(200, {"data": res if isinstance(dados, list) else res[0]})
+            self._resposta(404, {"errors": [{"message": "not found"}]})
+
+        def do_PATCH(self):
+            url = urlparse(self.path)
+            m = re.match(r'^/items/motoboys/(\d+)$', url.path)
+            corpo = self._corpo()
+            if url.path == '/items/motoboys':
+                # Update por query: {"query": {"filter": {campo: {op: valor}}}, "data": {...}}
+                if not self._simular('PATCH /items/motoboys'): return
+                dados = json.loads(corpo or b'{}')
+                filtro = (dados.get('query') or {}).get('filter') or {}
+                with banco.lock:
+                    alvos = [i for i in banco.itens.values()
+                             if all(_condicao(i, c, o, str(v)) for c, cond in filtro.items() for o, v in cond.items())]
+                    for item in alvos:
+                        item.update(dados.get('data') or {})
+                        item['date_updated'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+                fields = parse_qs(url.query).get('fields', [''])[0]
+                return self._resposta(200, {"data": [projetar(i, fields) for i in alvos]})
+            if not m:
+                return self._resposta(404, {"errors": [{"message": "not found"}]})
+            if not self._simular('PATCH /items/motoboys/:id'): return
+            with banco.lock:
+                item = banco.itens.get(int(m.group(1)))
+                if not item:
+                    return self._resposta(403, {"errors": [{"message": "forbidden"}]})
+                item.update(json.loads(corpo or b'{}'))
+                item['date_updated'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+            self._resposta(200, {"data": projetar(item, parse_qs(url.query).get('fields', [''])[0])})
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8055)
+    parser.add_argument('--riders', type=int, default=1000, help='motoboys pré-cadastrados (slug motoN)')
+    parser.add_argument('--domains', type=int, default=50, help='quantos têm domínio próprio motoN.bench.local')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    banco = Banco(args.riders, args.domains)
+    handler = criar_handler(banco, args.latency_ms, args.jitter_ms, args.error_rate)
+    servidor = ThreadingHTTPServer((args.host, args.port), handler)
+    servidor.daemon_threads = True
+    print(f"Directus falso em http://{args.host}:{args.port} ({args.riders} motoboys)", flush=True)
+    servidor.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Benchmark de carga do app contra o Directus falso.
+
+Cenários:
+  scan      - rajada de leituras de QR em /<slug> (distribuição concentrada em poucos slugs)
+  domain    - tráfego em domínio próprio (Host: motoN.bench.local) passando por verificar_dominio
+  login     - rajada de logins válidos
+  cadastro  - cadastros novos (slug/e-mail únicos)
+
+Para cada cenário: vazão, p50/p95/p99, códigos de status e chamadas ao Directus
+(diferença do /__stats do Directus falso antes/depois).
+
+Sobe tudo localmente (Directus falso + gunicorn com gunicorn.conf.py):
+    python bench/run.py --spawn --scenario all --requests 2000 --concurrency 50
+
+Contra um app já rodando:
+    python bench/run.py --target http://127.0.0.1:5000 --fake http://127.0.0.1:8055 --scenario scan
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# O app bloqueia user-agents de scripts (block_scrapers)
+USER_AGENT = "Mozilla/5.0 (Linux; Android 13) bench"
+SENHA_PADRAO = "senha123"
+
+_sessoes = threading.local()
+
+def sessao():
+    s = getattr(_sessoes, 's', None)
+    if s is None:
+        s = requests.Session()
+        s.headers['User-Agent'] = USER_AGENT
+        _sessoes.s = s
+    return s
+
+def escolher_slug(riders):
+    # Poucos motoboys concentram a maior parte das leituras (link compartilhado em grupo)
+    if random.random() < 0.8:
+        return f"moto{random.randrange(min(riders, 20))}"
+    return f"moto{random.randrange(riders)}"
+
+def req_scan(args, i):
+    return sessao().get(f"{args.target}/{escolher_slug(args.riders)}", allow_redirects=False)
+
+def req_domain(args, i):
+    host = f"moto{random.randrange(args.domains)}.bench.local"
+    caminho = random.choice(['/', '/', '/static/dist/manifest.json', '/favicon.ico'])
+    return sessao().get(f"{args.target}{caminho}", headers={'Host': host}, allow_redirects=False)
+
+def req_login(args, i):
+    n = random.randrange(args.riders)
+    # Cada request usa um IP diferente para não cair no rate limit
+    return sessao().post(
+        f"{args.target}/login",
+        data={'email': f"moto{n}@bench.local", 'senha': SENHA_PADRAO},
+        headers={'X-Forwarded-For': f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"},
+        allow_redirects=False,
+    )
+
+def req_cadastro(args, i):
+    sufixo = f"{args.run_id}{i}"
+    return sessao().post(
+        f"{args.target}/cadastro",
+        data={'slug': f"novo{sufixo}", 'email': f"novo{sufixo}@bench.local", 'nome': 'Bench', 'senha': SENHA_PADRAO},
+        headers={'X-Forwarded-For': f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"},
+        allow_redirects=False,
+    )
+
+CENARIOS = {
+    'scan': req_scan,
+    'domain': req_domain,
+    'login': req_login,
+    'cadastro': req_cadastro,
+}
+
+def percentil(valores, p):
+    if not valores: return 0.0
+    k = (len(valores) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(valores) - 1)
+    return valores[f] + (valores[c] - valores[f]) * (k - f)
+
+def stats_fake(args):
+    try:
+        return Counter(requests.get(f"{args.fake}/__stats", timeout=5).json())
+    except requests.RequestException:
+        return Counter()
+
+def rodar(args, nome):
+    funcao = CENARIOS[nome]
+    latencias, status = [], Counter()
+    lock = threading.Lock()
+
+    def um(i):
+        inicio = time.perf_counter()
+        try:
+            codigo = funcao(args, i).status_code
+        except requests.RequestException:
+            codigo = 'erro'
+        duracao = time.perf_counter() - inicio
+        with lock:
+            latencias.append(duracao)
+            status[codigo] += 1
+
+    antes = stats_fake(args)
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(um, range(args.requests)))
+    total = time.perf_counter() - inicio
+    upstream = stats_fake(args) - antes
+
+    latencias.sort()
+    return {
+        'cenario': nome,
+        'requests': args.requests,
+        'concorrencia': args.concurrency,
+        'rps': round(args.requests / total, 1),
+        'p50_ms': round(percentil(latencias, 50) * 1000, 1),
+        'p95_ms': round(percentil(latencias, 95) * 1000, 1),
+        'p99_ms': round(percentil(latencias, 99) * 1000, 1),
+        'status': dict(status),
+        'upstream': dict(upstream),
+        'upstream_por_request': round(sum(upstream.values()) / args.requests, 3),
+    }
+
+def aguardar(url, timeout=30):
+    limite = time.time() + timeout
+    while time.time() < limite:
+        try:
+            requests.get(url, timeout=1, headers={'User-Agent': USER_AGENT})
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise SystemExit(f"Timeout esperando {url}")
+
+def subir(args, processos):
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(RAIZ, 'bench', 'fake_directus.py'),
+        '--port', str(args.fake_port), '--riders', str(args.riders), '--domains', str(args.domains),
+        '--latency-ms', str(args.latency_ms), '--error-rate', str(args.error_rate),
+    ])
+    processos.append(fake)
+    aguardar(f"{args.fake}/__stats")
+    if fake.poll() is not None:
+        raise SystemExit(f"Directus falso não subiu (porta {args.fake_port} em uso?)")
+
+    env = dict(os.environ)
+    env.update({
+        'DIRECTUS_URL': args.fake,
+        'DIRECTUS_TOKEN': 'bench',
+        'BIND': f"127.0.0.1:{args.app_port}",
+        'SECRET_KEY': 'bench',
+    })
+    env.update(dict(v.split('=', 1) for v in args.env))
+    app = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'app:app'], cwd=RAIZ, env=env)
+    processos.append(app)
+    aguardar(f"{args.target}/")
+    requests.post(f"{args.fake}/__reset", timeout=5)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', default='all', help='scan, domain, login, cadastro ou all (separados por vírgula)')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--riders', type=int, default=1000)
+    parser.add_argument('--domains', type=int, default=50)
+    parser.add_argument('--target', default=None, help='URL do app (padrão: o app iniciado por --spawn)')
+    parser.add_argument('--fake', default=None, help='URL do Directus falso')
+    parser.add_argument('--spawn', action='store_true', help='inicia Directus falso e gunicorn localmente')
+    parser.add_argument('--app-port', type=int, default=5050)
+    parser.add_argument('--fake-port', type=int, default=8055)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--env', action='append', default=[], help='VAR=valor extra para o app (com --spawn)')
+    parser.add_argument('--json', action='store_true', help='saída em JSON (uma linha por cenário)')
+    args = parser.parse_args()
+
+    args.target = (args.target or f"http://127.0.0.1:{args.app_port}").rstrip('/')
+    args.fake = (args.fake or f"http://127.0.0.1:{args.fake_port}").rstrip('/')
+    args.run_id = f"{int(time.time()) % 100000}x"
+    nomes = list(CENARIOS) if args.scenario == 'all' else args.scenario.split(',')
+
+    processos = []
+    try:
+        if args.spawn:
+            subir(args, processos)
+        for nome in nomes:
+            resultado = rodar(args, nome)
+            if args.json:
+                print(json.dumps(resultado))
+                continue
+            print(
+                f"{nome:9s} {resultado['rps']:>8} req/s  p50 {resultado['p50_ms']:>7} ms  "
+                f"p95 {resultado['p95_ms']:>7} ms  p99 {resultado['p99_ms']:>7} ms  "
+                f"upstream/req {resultado['upstream_por_request']:<6} status {resultado['status']}"
+            )
+            for rota, n in sorted(resultado['upstream'].items()):
+                print(f"{'':9s}   {n:>7}  {rota}")
+    finally:
+        for p in reversed(processos):
+            p.terminate()
+            p.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Gera os assets estáticos servidos pelo app (rodar no build da imagem).
+
+- static/dist/app.<hash>.css: Tailwind compilado só com as classes usadas nos templates, minificado
+- static/dist/icons.<hash>.svg: sprite com apenas os ícones Lucide usados
+- static/dist/manifest.json: nome lógico -> arquivo com hash
+
+Requer `npm install` antes (tailwindcss e lucide-static em node_modules).
+"""
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+DIST = os.path.join(RAIZ, 'static', 'dist')
+ICONES_DIR = os.path.join(RAIZ, 'node_modules', 'lucide-static', 'icons')
+
+# Ícones usados via macro icone('nome', ...) ou data-lucide="nome"
+RE_ICONE = re.compile(r"""icone\(\s*['"]([a-z0-9-]+)['"]|data-lucide=["']([a-z0-9-]+)["']""")
+RE_SVG = re.compile(r'<svg[^>]*>(.*)</svg>', re.S)
+
+def gravar_com_hash(nome, conteudo):
+    base, ext = os.path.splitext(nome)
+    impressao = hashlib.sha256(conteudo).hexdigest()[:12]
+    final = f"{base}.{impressao}{ext}"
+    with open(os.path.join(DIST, final), 'wb') as f:
+        f.write(conteudo)
+    return final
+
+def compilar_css():
+    saida = os.path.join(DIST, '.app.css')
+    subprocess.run(
+        ['npx', 'tailwindcss', '-c', 'tailwind.config.js', '-i', 'assets/app.css', '-o', saida, '--minify'],
+        cwd=RAIZ, check=True,
+    )
+    with open(saida, 'rb') as f:
+        css = f.read()
+    os.remove(saida)
+    return css
+
+def montar_sprite():
+    nomes = set()
+    for caminho in glob.glob(os.path.join(RAIZ, 'templates', '*.html')):
+        with open(caminho, encoding='utf-8') as f:
+            for m in RE_ICONE.finditer(f.read()):
+                nomes.add(m.group(1) or m.group(2))
+
+    simbolos = []
+    for nome in sorted(nomes):
+        with open(os.path.join(ICONES_DIR, f"{nome}.svg"), encoding='utf-8') as f:
+            interno = RE_SVG.search(f.read()).group(1)
+        interno = re.sub(r'>\s+<', '><', interno.strip())
+        # Atributos de traço do Lucide vão no <symbol>: o <use> herda do símbolo, não do sprite
+        simbolos.append(
+            f'<symbol id="i-{nome}" viewBox="0 0 24 24" fill="none" stroke="currentColor" '
+            f'stroke-width="2" stroke-linecap="round" stroke-linejoin="round">{interno}</symbol>'
+        )
+
+    sprite = '<svg xmlns="http://www.w3.org/2000/svg" style="display:none">' + ''.join(simbolos) + '</svg>'
+    return sprite.encode('utf-8'), sorted(nomes)
+
+def main():
+    os.makedirs(DIST, exist_ok=True)
+    for antigo in glob.glob(os.path.join(DIST, '*.*.css')) + glob.glob(os.path.join(DIST, '*.*.svg')):
+        os.remove(antigo)
+
+    manifesto = {}
+    manifesto['app.css'] = gravar_com_hash('app.css', compilar_css())
+    sprite, nomes = montar_sprite()
+    manifesto['icons.svg'] = gravar_com_hash('icons.svg', sprite)
+
+    with open(os.path.join(DIST, 'manifest.json'), 'w') as f:
+        json.dump(manifesto, f, indent=2)
+    print(f"CSS: {manifesto['app.css']} | Ícones ({len(nomes)}): {', '.join(nomes)}")
+
+if __name__ == '__main__':
+    sys.exit(main())
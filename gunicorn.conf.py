@@ -0,0 +1,74 @@
+# Configuração do gunicorn (usada pelo Dockerfile: gunicorn -c gunicorn.conf.py app:app)
+#
+# SERVING_MODE=sync   -> workers síncronos (um request por vez por worker)
+# SERVING_MODE=gevent -> workers gevent: requests/smtplib/socket viram cooperativos
+#                        e cada worker atende milhares de conexões esperando o Directus,
+#                        com as mesmas rotas e templates
+import os
+
+SERVING_MODE = os.getenv("SERVING_MODE", "sync")
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 20))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Importa o app e aquece os caches uma vez no master; os workers herdam por fork
+# (copy-on-write) e já nascem com perfis e domínios carregados
+preload_app = os.getenv("PRELOAD_APP", "True") == "True"
+
+if SERVING_MODE == "gevent":
+    if preload_app:
+        # Com preload o app é importado no master: o patch precisa vir antes, senão
+        # locks, filas e sockets criados no import ficam bloqueantes nos workers
+        from gevent import monkey
+        monkey.patch_all()
+    worker_class = "gevent"
+    worker_connections = int(os.getenv("WORKER_CONNECTIONS", 2000))
+    # Com muitas conexões simultâneas por worker o pool HTTP precisa acompanhar
+    os.environ.setdefault("DIRECTUS_POOL_MAXSIZE", "100")
+    # Buscas com orçamento (cópia local velha) rodam no refresh_executor: com
+    # threads viradas greenlets, o teto acompanha as conexões do worker
+    os.environ.setdefault("PROFILE_REFRESH_WORKERS", str(worker_connections))
+else:
+    worker_class = "sync"
+
+# Métricas somadas entre workers: cada um grava seu snapshot neste diretório
+os.environ.setdefault("METRICS_DIR", "/tmp/motoboys_metrics")
+
+def on_starting(server):
+    # Descarta snapshots de uma execução anterior
+    diretorio = os.environ["METRICS_DIR"]
+    if os.path.isdir(diretorio):
+        for nome in os.listdir(diretorio):
+            if nome.endswith('.json'):
+                os.remove(os.path.join(diretorio, nome))
+
+def when_ready(server):
+    # Roda no master, antes do fork dos workers. Threads de fundo do app só
+    # sobem depois, em cada worker (todas checam o pid)
+    if not server.cfg.preload_app:
+        return
+    import gc
+    import app
+    app.aquecimento.executar()
+    # O que foi carregado vai para a geração permanente: o GC dos workers não
+    # percorre esses objetos e as páginas continuam compartilhadas
+    gc.freeze()
+
+def post_worker_init(worker):
+    import app
+    # Envio de e-mails sobe no boot do worker: o que ficou no spool de um worker
+    # morto (restart/deploy) sai sem esperar o próximo "esqueci a senha"
+    app.mail_dispatcher.iniciar()
+    if not worker.cfg.preload_app:
+        app.aquecimento.iniciar()
+
+def worker_exit(server, worker):
+    # Guarda os slugs quentes deste worker para o aquecimento do próximo boot
+    try:
+        import app
+        app.salvar_snapshot_quentes()
+    except Exception as e:
+        print(f"Erro gravando snapshot de perfis quentes: {e}")
@@ -0,0 +1,73 @@
+// Service worker da página SOS: a última versão de cada perfil visitado fica no
+// aparelho. Cada leitura do adesivo tenta a rede primeiro (dados de emergência
+// precisam estar atuais); se a rede falha ou demora mais que TEMPO_REDE, abre a
+// cópia guardada. Só guarda respostas marcadas com X-SOS-Perfil (página e
+// /<slug>.json quando pedidos dentro do escopo); /static e /img (imutáveis)
+// saem do cache direto.
+const CACHE = 'sos-v1';
+const MAX_PERFIS = 30;
+const TEMPO_REDE = 3000;
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil(
+        caches.keys()
+            .then((nomes) => Promise.all(nomes.filter((n) => n !== CACHE).map((n) => caches.delete(n))))
+            .then(() => self.clients.claim())
+    );
+});
+
+function guardavel(resp) {
+    return resp && resp.ok && !resp.redirected && resp.headers.has('X-SOS-Perfil');
+}
+
+function recurso(url) {
+    return url.pathname.startsWith('/static/') || url.pathname.startsWith('/img/');
+}
+
+async function limitar(cache) {
+    const chaves = (await cache.keys()).filter((req) => !recurso(new URL(req.url)));
+    for (const req of chaves.slice(0, Math.max(0, chaves.length - MAX_PERFIS))) {
+        await cache.delete(req);
+    }
+}
+
+async function atualizar(req) {
+    const resp = await fetch(req);
+    const url = new URL(req.url);
+    if (guardavel(resp) || (recurso(url) && resp.ok)) {
+        const cache = await caches.open(CACHE);
+        await cache.put(req, resp.clone());
+        if (!recurso(url)) await limitar(cache);
+    } else if (resp.status === 404 || resp.status === 410) {
+        // Perfil removido: a cópia antiga não pode continuar abrindo
+        await caches.open(CACHE).then((cache) => cache.delete(req));
+    }
+    return resp;
+}
+
+function redePrimeiro(event, req) {
+    const rede = atualizar(req);
+    event.waitUntil(rede.catch(() => {}));
+    const espera = new Promise((resolve) => setTimeout(resolve, TEMPO_REDE));
+    const copiaSeLenta = espera.then(() => caches.match(req, { ignoreVary: true })).then((copia) => copia || rede);
+    const copiaSeFalha = rede.catch(() => caches.match(req, { ignoreVary: true }).then((copia) => {
+        if (copia) return copia;
+        throw new Error('sem rede e sem cópia');
+    }));
+    // Rede respondeu a tempo (ou falhou): vale ela/cópia; demorou: cópia, se houver
+    return Promise.race([copiaSeFalha, copiaSeLenta]);
+}
+
+self.addEventListener('fetch', (event) => {
+    const req = event.request;
+    const url = new URL(req.url);
+    if (req.method !== 'GET' || url.origin !== self.location.origin) return;
+
+    if (recurso(url)) {
+        event.respondWith(caches.match(req, { ignoreVary: true }).then((copia) => copia || atualizar(req)));
+        return;
+    }
+    event.respondWith(redePrimeiro(event, req));
+});